@@ -0,0 +1,282 @@
+"""
+Micro benchmarks of the game logic hot paths
+
+Every benchmark builds its game once per parameters combination and times one call of the measured code.
+The results can be saved as JSON and compared against a baseline saved the same way:
+
+    python benchmarks.py --save baseline.json
+    python benchmarks.py --baseline baseline.json     # exits with 1 if a benchmark got slower than the tolerance
+    python benchmarks.py --filter bomb --quick
+    python benchmarks.py --memory                     # exits with 1 if a match takes more than MATCH_MEMORY_TARGET
+"""
+import sys
+import json
+import time
+import timeit
+import argparse
+import itertools
+import platform
+import statistics
+import tracemalloc
+
+import config
+# developer note: player must be imported from before game_file to avoid circular importing
+import player
+from game_file import Game, Power
+from game_map import GameMap, load_map
+from common import ActionType, PlayerRole, Team
+
+
+BOARD_SIZES = [15, 30, 60, 100]
+MAP_NAMES = ["alpha", "alpha_60", "alpha_100"]  # maps in the maps directory, from the default one up
+PATH_LENGTHS = [10, 100]
+MINE_COUNTS = [10, 100]
+# the board the captain sees while choosing the target of a power
+BOARD_OVERLAYS = {"none": None, "torpedo": ActionType.TORPEDO, "activate_mine": ActionType.ACTIVATE_MINE,
+                  "silence": ActionType.SILENCE, "drone": ActionType.DRONE}
+
+REPEAT = 5
+QUICK_REPEAT = 2
+MIN_TIME = 0.2  # seconds each timing runs for at least
+QUICK_MIN_TIME = 0.02
+DEFAULT_TOLERANCE = 0.1  # a benchmark more than 10% slower than the baseline is a regression
+MEMORY_MATCHES = 100
+MATCH_MEMORY_TARGET = 16 * 1024  # bytes a match with all its players and their first states may take
+
+
+def new_game(board_size=None, map_name=None):
+    """
+    Returns a new game on a square board with the default map's islands, or on the named map if no size is given
+    The game is on the default map if neither is given
+    """
+    if board_size is None:
+        return Game(load_map(map_name)) if map_name else Game()
+    islands = load_map(config.DEFAULT_MAP).islands
+    return Game(GameMap(f"benchmark {board_size}", board_size, board_size, islands))
+
+
+def water_cells(game, count, skip=()):
+    """
+    Returns the first count cells that are not islands, row by row
+    """
+    return [cords for cords in game.map.water_cells() if cords not in skip][:count]
+
+
+def captain_at_center(game, path_length, team=Team.BLUE):
+    """
+    Returns the captain of the team, its submarine at the center of the board after path_length moves
+    """
+    captain = game.add_new_player(team, PlayerRole.CAPTAIN)
+    center = game.map.height // 2, game.map.width // 2
+    captain.submarine.path = [cords for cords in water_cells(game, path_length + 1, skip=[center])][:path_length]
+    captain.submarine.path.append(center)
+    captain.submarine.loc = center
+    return captain
+
+
+def bench_cells_in_range(board_size, max_range):
+    """
+    Times the query once the start cell's distances were computed
+    """
+    game = new_game(board_size)
+    start_loc = board_size // 2, board_size // 2
+    game.distances.cells_in_range(start_loc, max_range)
+    return lambda: game.distances.cells_in_range(start_loc, max_range)
+
+
+def bench_get_board_string(board_size, overlay, path_length):
+    game = new_game(board_size)
+    captain = captain_at_center(game, path_length)
+    captain.submarine.mines = water_cells(game, 10)
+    if BOARD_OVERLAYS[overlay] is not None:
+        power = Power(captain, BOARD_OVERLAYS[overlay])
+        power.is_need_to_act_captain_show_board = True
+        game.power_in_action = power
+    return lambda: captain.get_board_string(game)
+
+
+def bench_bomb_chain(map_name, mines):
+    """
+    The submarine's mines are packed next to each other, so bombing the first one blows them all
+    Restoring the mines before each bomb is part of the timing
+    """
+    game = new_game(map_name=map_name)
+    captain = captain_at_center(game, 1)
+    enemy = captain_at_center(game, 1, Team.YELLOW)
+    submarine = captain.submarine
+    mine_cells = water_cells(game, mines)
+
+    def bomb():
+        submarine.mines = list(mine_cells)
+        submarine.hp = enemy.submarine.hp = 4
+        submarine.bomb(game, mine_cells[0])
+    return bomb
+
+
+def bench_get_possible_silence_cords(board_size, path_length):
+    game = new_game(board_size)
+    submarine = captain_at_center(game, path_length).submarine
+    return lambda: submarine.get_possible_silence_cords(game)
+
+
+def bench_can_plant_mine(map_name, path_length, mines):
+    game = new_game(map_name=map_name)
+    submarine = captain_at_center(game, path_length).submarine
+    submarine.mines = water_cells(game, mines, skip=submarine.path)
+    submarine.mine_action.charge = submarine.mine_action.max_charge
+    return lambda: submarine.can_plant_mine(game)
+
+
+def bench_get_tools_state():
+    game = new_game()
+    engineer = game.add_new_player(Team.BLUE, PlayerRole.ENGINEER)
+    engineer.submarine.last_move_direction = "1 - N"
+    engineer.submarine.is_engineer_check = False
+    for tool in engineer.submarine.tools[::3]:
+        tool.brake()
+    return lambda: engineer.get_tools_state(game)
+
+
+def bench_new_game():
+    return lambda: Game()
+
+
+def bench_state_eq(board_size):
+    """
+    Compares two equal captain states that are not the same object
+    """
+    game = new_game(board_size)
+    captain = captain_at_center(game, 10)
+    state = captain.build_state(game)
+    other_state = captain.build_state(game)
+    return lambda: state == other_state
+
+
+# benchmark name: (benchmark, {parameter name: values})
+BENCHMARKS = {
+    "cells_in_range": (bench_cells_in_range, {"board_size": BOARD_SIZES, "max_range": [4, 7, 20]}),
+    "get_board_string": (bench_get_board_string, {"board_size": BOARD_SIZES, "overlay": BOARD_OVERLAYS,
+                                                  "path_length": PATH_LENGTHS}),
+    "bomb_chain": (bench_bomb_chain, {"map_name": MAP_NAMES, "mines": MINE_COUNTS}),
+    "get_possible_silence_cords": (bench_get_possible_silence_cords, {"board_size": BOARD_SIZES,
+                                                                      "path_length": PATH_LENGTHS}),
+    "can_plant_mine": (bench_can_plant_mine, {"map_name": MAP_NAMES, "path_length": PATH_LENGTHS,
+                                              "mines": MINE_COUNTS}),
+    "get_tools_state": (bench_get_tools_state, {}),
+    "state_eq": (bench_state_eq, {"board_size": BOARD_SIZES}),
+    "new_game": (bench_new_game, {}),
+}
+
+
+def new_match():
+    """
+    Returns a game on the default map with all its players, each after building its first state
+    """
+    game = new_game()
+    for team in Team:
+        for role in PlayerRole:
+            game.add_new_player(team, role)
+    for curr_player in game.players:
+        curr_player.get_state(game)
+    return game
+
+
+def match_memory(matches=MEMORY_MATCHES):
+    """
+    Returns the bytes allocated per match while creating matches, kept alive, the map's shared data excluded
+    """
+    new_match()  # the map, its masks and distances are shared by the matches, created once
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        games = [new_match() for _ in range(matches)]
+        allocated = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del games
+    return allocated / matches
+
+
+def benchmark_cases(name_filter=None):
+    """
+    Yields the full name, benchmark and parameters of every combination of every benchmark's parameters
+    """
+    for name, (benchmark, params) in BENCHMARKS.items():
+        for values in itertools.product(*params.values()):
+            kwargs = dict(zip(params, values))
+            full_name = name + "".join(f"[{param}={value}]" for param, value in kwargs.items())
+            if not name_filter or name_filter in full_name:
+                yield full_name, benchmark, kwargs
+
+
+def time_call(func, repeat, min_time):
+    """
+    Returns the seconds per call of every timing, each timing runs func enough times to last min_time
+    """
+    timer = timeit.Timer(func)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    return [total / number for total in timer.repeat(repeat, number)]
+
+
+def run(name_filter=None, quick=False):
+    results = {}
+    for full_name, benchmark, kwargs in benchmark_cases(name_filter):
+        times = time_call(benchmark(**kwargs), QUICK_REPEAT if quick else REPEAT, QUICK_MIN_TIME if quick else MIN_TIME)
+        results[full_name] = {"min_us": min(times) * 1e6, "median_us": statistics.median(times) * 1e6}
+        print(f"{full_name:80} {results[full_name]['min_us']:12.2f}us")
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints every benchmark's change from the baseline and returns the names of the regressions
+    """
+    regressions = []
+    print(f"\n{'benchmark':80} {'baseline':>12} {'now':>12} {'change':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, now = baseline[name]["min_us"], result["min_us"]
+        change = now / before - 1
+        mark = ""
+        if change > tolerance:
+            regressions.append(name)
+            mark = " slower"
+        print(f"{name:80} {before:10.2f}us {now:10.2f}us {100 * change:+7.1f}%{mark}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--filter", help="only run benchmarks whose name contains this")
+    parser.add_argument("--quick", action="store_true", help="shorter and noisier timings")
+    parser.add_argument("--save", help="file to save the results to as JSON")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--memory", action="store_true", help="measure the memory of a match instead of timing")
+    args = parser.parse_args()
+
+    if args.memory:
+        per_match = match_memory()
+        print(f"{per_match / 1024:.1f}KiB per match, target {MATCH_MEMORY_TARGET / 1024:.1f}KiB")
+        if per_match > MATCH_MEMORY_TARGET:
+            sys.exit(1)
+        return
+
+    results = run(args.filter, args.quick)
+    if args.save:
+        with open(args.save, "w") as results_file:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(), "time": time.time(),
+                       "results": results}, results_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file)["results"], args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} benchmarks are more than {100 * args.tolerance:.0f}% slower")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Boards as integer bit masks: bit row * width + col is set for the cell (row, col)
+
+A question about the whole board, like where the submarine can move, is a few operations on ints
+instead of a membership test per cell, and a board string is drawn from the masks in one pass.
+"""
+
+
+DIRECTIONS = ((-1, 0), (0, 1), (1, 0), (0, -1))  # N, E, S, W
+
+
+class BoardMasks:
+    """
+    The masks of a map and the operations on masks of its size
+    """
+    def __init__(self, height, width, islands, section_size):
+        self.height = height
+        self.width = width
+        self.cells_count = height * width
+        self.full = (1 << self.cells_count) - 1
+        self.islands = self.mask(islands)
+        self.water = self.full & ~self.islands
+        self.first_col = self.mask((row, 0) for row in range(height))
+        self.last_col = self.mask((row, width - 1) for row in range(height))
+        self.drone_targets = self.mask((row, col) for row in range(height) for col in range(width)  # sections' centers
+                                       if row % section_size == col % section_size == section_size // 2)
+        self.translations = {}  # base char: the translation of a mask's bits to a board string
+        self.stencils = {}  # offsets: the masks of the offsets around every cell, filled as cells are asked for
+        self.ray_tables = {}  # length: the rays of every cell, filled as cells are asked for
+
+    def in_map(self, loc):
+        return 0 <= loc[0] < self.height and 0 <= loc[1] < self.width
+
+    def bit(self, loc):
+        """
+        Returns the mask of a single cell, 0 for None or a cell outside the map
+        """
+        if loc is None or not self.in_map(loc):
+            return 0
+        return 1 << (loc[0] * self.width + loc[1])
+
+    def mask(self, cords):
+        mask = 0
+        for loc in cords:
+            mask |= self.bit(loc)
+        return mask
+
+    def stencil(self, loc, offsets):
+        """
+        Returns the mask of the cells at the offsets, (d_row, d_col), from loc, computed once per cell of the map
+        The mask around a loc outside the map is computed every time, it has no cell to be kept for
+        """
+        if not self.in_map(loc):
+            return self.mask((loc[0] + d_row, loc[1] + d_col) for d_row, d_col in offsets)
+        if offsets not in self.stencils:
+            self.stencils[offsets] = [None] * self.cells_count
+        cell_masks = self.stencils[offsets]
+        index = loc[0] * self.width + loc[1]
+        if cell_masks[index] is None:
+            cell_masks[index] = self.mask((loc[0] + d_row, loc[1] + d_col) for d_row, d_col in offsets)
+        return cell_masks[index]
+
+    def rays(self, loc, length):
+        """
+        Returns the cells in a straight line from loc in every direction, nearest first, up to length cells,
+        each ray stopping before the first island or the edge of the map, computed once per cell
+        A ray is a tuple of (cords, index of the cell's bit)
+        """
+        if length not in self.ray_tables:
+            self.ray_tables[length] = [None] * self.cells_count
+        cell_rays = self.ray_tables[length]
+        index = loc[0] * self.width + loc[1]
+        if cell_rays[index] is None:
+            rays = []
+            for d_row, d_col in DIRECTIONS:
+                ray = []
+                for step in range(1, length + 1):
+                    cell = loc[0] + d_row * step, loc[1] + d_col * step
+                    if not self.in_map(cell) or self.bit(cell) & self.islands:
+                        break
+                    ray.append((cell, cell[0] * self.width + cell[1]))
+                rays.append(tuple(ray))
+            cell_rays[index] = tuple(rays)
+        return cell_rays[index]
+
+    def shift(self, mask, direction):
+        """
+        Moves every cell of the mask one step in the direction, (d_row, d_col), cells leaving the map are dropped
+        """
+        d_row, d_col = direction
+        if d_row == 1:
+            return (mask << self.width) & self.full
+        if d_row == -1:
+            return mask >> self.width
+        if d_col == 1:
+            return (mask & ~self.last_col) << 1
+        return (mask & ~self.first_col) >> 1
+
+    def neighbors(self, mask):
+        """
+        Returns the cells next to the mask's cells, not diagonally
+        """
+        return ((mask << self.width) & self.full) | (mask >> self.width) \
+            | ((mask & ~self.last_col) << 1) | ((mask & ~self.first_col) >> 1)
+
+    @staticmethod
+    def indices(mask):
+        """
+        Yields the indices of the mask's cells, lowest first
+        """
+        while mask:
+            lowest = mask & -mask
+            yield lowest.bit_length() - 1
+            mask ^= lowest
+
+    def cords(self, mask):
+        return [divmod(index, self.width) for index in self.indices(mask)]
+
+    def board_string(self, base_mask, base_char="y", marks=()):
+        """
+        Returns the board string with base_char on the cells of base_mask and "w" (white) elsewhere,
+        then every (mask, char) of marks drawn over it, later marks over earlier ones
+        """
+        if base_char not in self.translations:
+            self.translations[base_char] = str.maketrans("01", "w" + base_char)
+        # the bits of the mask as "0"s and "1"s, the first cell first
+        chars = list(format(base_mask, f"0{self.cells_count}b")[::-1].translate(self.translations[base_char]))
+        for mask, char in marks:
+            for index in self.indices(mask):
+                chars[index] = char
+        return "".join(chars)
@@ -0,0 +1,83 @@
+import time
+from functools import partial
+
+# developer note: player must be imported from before game_file to avoid circular importing
+from player import ViewState
+from game_file import ALL_VIEWS
+from common import Team, PlayerRole
+from metrics import metrics
+import protocol
+
+
+def spectated_views(team=None):
+    """
+    Returns the views of a spectator watching the team's submarine, or both submarines if team is None
+    """
+    teams = Team if team is None else (Team(team),)
+    return [(curr_team, role) for curr_team in teams for role in PlayerRole]
+
+
+class Broadcast:
+    """
+    Sends the changes of a game's views to the spectators watching them
+    A view's state is built and encoded once per change, and the same frame is sent to every spectator of the view.
+    Runs on the game's actor: changes are collected while a command runs and sent once it is done
+    """
+    def __init__(self, game, run):
+        self.game = game
+        self.run = run  # queues a function to run on the game's actor
+        self.spectators = {view: [] for view in ALL_VIEWS}
+        self.callbacks = {view: partial(self.view_changed, view) for view in ALL_VIEWS}
+        self.view_players = {}  # build the views' states, they never join the game
+        self.frames = {}  # view: (the view's last sent state, its frame)
+        self.changed_views = set()
+
+    def add(self, views, send):
+        """
+        Calls send(view, frame) with the frame of every change to the views, starting with their current states
+        """
+        for view in views:
+            if not self.spectators[view]:
+                self.game.subscribe(view, self.callbacks[view])
+            self.spectators[view].append(send)
+            send(view, self.frame(view))
+
+    def remove(self, views, send):
+        for view in views:
+            self.spectators[view].remove(send)
+            if not self.spectators[view]:
+                self.game.unsubscribe(view, self.callbacks[view])
+                self.frames.pop(view, None)
+
+    def view_changed(self, view):
+        """
+        Called by the game in the middle of a change, the frames are built once the command is done
+        """
+        if not self.changed_views:
+            self.run(self.flush)
+        self.changed_views.add(view)
+
+    def flush(self):
+        changed_views, self.changed_views = self.changed_views, set()
+        for view in changed_views:
+            last_frame = self.frames.get(view, (None, None))[1]
+            frame = self.frame(view)
+            if frame is last_frame or not self.spectators[view]:
+                continue
+            for send in tuple(self.spectators[view]):
+                send(view, frame)
+
+    def frame(self, view):
+        """
+        Returns the frame of the view's current state, encoded only if the state changed since it was last encoded
+        """
+        if view not in self.view_players:
+            self.view_players[view] = self.game.create_player(*view)
+        state = self.view_players[view].get_state(self.game)
+        last_state, frame = self.frames.get(view, (None, None))
+        if last_state is None or state != last_state:
+            start = time.perf_counter()
+            frame = protocol.encode(ViewState(*view, state))
+            metrics.observe("broadcast_encode_seconds", time.perf_counter() - start)
+            self.frames[view] = state, frame
+        return frame
@@ -2,10 +2,9 @@ import math
 import pygame
 import pygame_menu
 
-from player import CaptainState, FirstMateState, EngineerState, RadioOperatorState
+from player import CaptainState, CaptainBoardDelta, FirstMateState, EngineerState, RadioOperatorState
 from network import Network
 from common import Color, PlayerRole, Team, DrawingTool, ActionType
-from config import BOARD_HEIGHT, BOARD_WIDTH
 
 
 
@@ -101,6 +100,7 @@ class PlayerClient:
         self.clicked_locations = set()
         self.background_image = self.load_background_image()
         self.my_team, self.my_role = role_pick
+        self.network.push_handler = self.update_state
 
     def play(self):
         """
@@ -185,8 +185,12 @@ class PlayerClient:
     def update_state(self, state_tuple):
         """
         Gets a tuple of the new state and updates the current state
+        Captain board deltas are applied on top of the current state
         """
-        self.state = STATE_CLASS_MAP[self.__class__](*state_tuple)
+        if isinstance(state_tuple, CaptainBoardDelta):
+            self.state = state_tuple.apply(self.state)
+        else:
+            self.state = STATE_CLASS_MAP[self.__class__](*state_tuple)
 
     def request_game_state(self):
         """
@@ -200,13 +204,9 @@ class PlayerClient:
 
     def listen_for_server_update(self):
         """
-        Checks if the server notified about sending an updated game state
-        If so, listens until the new game state will be recieved
+        Handles the replies and the game state updates the server sent since the last check
         """
-        got = self.network.listen(blocking=False)
-        if got:
-            if got == "sending game state":
-                self.update_state(self.network.listen())
+        self.network.poll()
 
     def draw_stop_screen(self):
         """
@@ -217,10 +217,10 @@ class PlayerClient:
 
     def send_action_to_server(self, action_name, action_value):
         """
-        Sends action to the server and listens for response
+        Sends action to the server without waiting for the response,
+        the state is updated once the response arrives
         """
-        self.network.only_send(action_name)
-        return self.network.send(action_value)
+        self.network.request((action_name, action_value), self.update_state)
 
     def play_turn(self):
         """
@@ -329,7 +329,7 @@ class CaptainClient(PlayerClient):
     def play_turn(self):
         target_clicked = self.detect_target_clicked()
         if target_clicked:
-            self.update_state(self.send_action_to_server("captain clicked loc", target_clicked))
+            self.send_action_to_server("captain clicked loc", target_clicked)
 
     def play_outside_of_turn(self):
         if not self.state.is_game_stopped \
@@ -390,7 +390,7 @@ class CaptainClient(PlayerClient):
             self.screen.fill(Color.BLACK)
             msg = "stopped"
             if self.state.power_in_action:
-                if self.state.power_in_action.activated_captain.team == self.my_team:
+                if self.state.power_in_action.activated_team == self.my_team:
                     msg = self.state.power_in_action.activated_captain_msg
                 else:
                     msg = self.state.power_in_action.other_captain_msg
@@ -407,10 +407,11 @@ class CaptainClient(PlayerClient):
     def send_sonar_statement(self, true_statement_selector, false_statement_type_selector, false_statement_data_text_input, sonar_menu):
         if true_statement_selector.get_value() == false_statement_type_selector.get_value():
             return
-        self.update_state(self.send_action_to_server("captain sonar answer",
-                                                     (true_statement_selector.get_value()[0],
-                                                      false_statement_type_selector.get_value()[0],
-                                                      false_statement_data_text_input.get_value())))
+        # waits for the response so the sonar menu won't be shown again
+        self.update_state(self.network.send(("captain sonar answer",
+                                             (true_statement_selector.get_value()[0],
+                                              false_statement_type_selector.get_value()[0],
+                                              false_statement_data_text_input.get_value()))))
         sonar_menu.disable()
 
 
@@ -436,15 +437,16 @@ class CaptainClient(PlayerClient):
         If so, return the coordinates of the circle
         Otherwise return None
         """
+        board_width = self.state.board_width
         for clicked_x, clicked_y in self.clicked_locations:
-            for i in range(BOARD_HEIGHT):
-                for j in range(BOARD_WIDTH):
+            for i in range(len(self.state.board_str) // board_width):
+                for j in range(board_width):
                     # params of the (i, j) circle in the board
                     (circle_x, circle_y), circle_radius = self.get_board_circle_params(i, j)
 
                     # if clicked location is in the (i, j) circle and the circle is yellow
                     if math.hypot(circle_x - clicked_x, circle_y - clicked_y) < circle_radius:
-                        if self.state.board_str[BOARD_HEIGHT * i + j] == "y":
+                        if self.state.board_str[board_width * i + j] == "y":
                             return (i, j)
         return None
 
@@ -452,9 +454,10 @@ class CaptainClient(PlayerClient):
         """
         Draws the captain board according to the current state
         """
-        for i in range(BOARD_HEIGHT):
-            for j in range(BOARD_WIDTH):
-                char = self.state.board_str[i * BOARD_HEIGHT + j]
+        board_width = self.state.board_width
+        for i in range(len(self.state.board_str) // board_width):
+            for j in range(board_width):
+                char = self.state.board_str[i * board_width + j]
                 circle_params = self.get_board_circle_params(i, j)
 
                 if char:
@@ -500,8 +503,7 @@ class FirstMateClient(PlayerClient):
 
         if power_clicked:
             # power clicked is sent to the server as the index of the power in power_rects
-            self.update_state(self.send_action_to_server("first mate clicked power",
-                                                         self.powers_rects.index(power_clicked)))
+            self.send_action_to_server("first mate clicked power", self.powers_rects.index(power_clicked))
 
     def draw(self):
         self.draw_charge_bars()
@@ -548,8 +550,7 @@ class EngineerClient(PlayerClient):
             tool_clicked_cords = [(i, colour.index(tool_clicked))
                                   for i, colour in enumerate(self.tools_rects)
                                   if tool_clicked in colour][0]
-            self.update_state(self.send_action_to_server("engineer clicked tool",
-                                                         tool_clicked_cords))
+            self.send_action_to_server("engineer clicked tool", tool_clicked_cords)
 
     def draw(self):
         for tool in self.state.tools_state:
@@ -752,14 +753,29 @@ def play_role(network, screen, role_pick):
         pygame.quit()
 
 
-def start_game(network, screen, team_selector, role_selector, start_game_menu):
+def create_game(network, game_id_text_input):
+    """
+    Asks the server's lobby to create a new game and fills in its id
+    """
+    game_id_text_input.set_value(network.send("lobby create"))
+
+
+def start_game(network, screen, team_selector, role_selector, game_id_text_input, start_game_menu):
     """
     Starts the game.
+    Joins the chosen game (the server's default game if none chosen),
     Sends team & role pick to server,
     Initializes the player client if role approved
     """
     role_pick = team_selector.get_value()[1], role_selector.get_value()[1]
 
+    # join the chosen game
+    game_id = game_id_text_input.get_value()
+    if game_id and network.send(f"lobby join {game_id}") != "joined":
+        if not start_game_menu.get_widget("no such game"):
+            start_game_menu.add_label("no such game", "no such game")
+        return
+
     # send role pick to the server
     server_response = network.send(role_pick)
 
@@ -809,12 +825,20 @@ def main():
                                                   ('engineer', PlayerRole.ENGINEER),
                                                   ('radio operator', PlayerRole.RADIO_OPERATOR)])
 
+    game_id_text_input = start_game_menu.add_text_input('Game :', maxchar=10)
+
+    start_game_menu.add_button('New game',
+                               create_game,
+                               network,
+                               game_id_text_input)
+
     start_game_menu.add_button('Play',
                                start_game,
                                network,
                                screen,
                                team_selector,
                                role_selector,
+                               game_id_text_input,
                                start_game_menu)
 
     start_game_menu.add_button('Quit', pygame_menu.events.EXIT)
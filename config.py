@@ -1,3 +1,3 @@
-BOARD_WIDTH = 15
-BOARD_HEIGHT = 15
+DEFAULT_MAP = "alpha"  # the map games are played on unless another is chosen, a file in the maps directory
+DISTANCE_CACHE_DIR = None  # directory the distance tables of big maps are saved to and memory-mapped from
 
@@ -0,0 +1,166 @@
+"""
+Island-aware distances between the cells of a map, for weapons whose range is measured along the water
+
+The distances from a cell are found by one BFS the first time they are needed, and kept as the cells reachable
+from it in BFS order with their distances, so the cells within range of a cell are a prefix of its row,
+found by a binary search. The most recently used rows are kept, and a map's table is shared by all the games
+played on it.
+The table of a big map can be computed whole once and saved to a file, which later servers memory-map
+instead of computing it again. The rows of a map too big for that are not kept: every query runs a BFS
+that stops at its range, so it only visits the cells it returns.
+"""
+import os
+import mmap
+import array
+import bisect
+import hashlib
+import threading
+from collections import deque, OrderedDict
+
+
+UNREACHABLE = 0xFFFF  # the distance of the cells a row doesn't reach, only stored in files
+DIRECTIONS = ((-1, 0), (1, 0), (0, -1), (0, 1))
+MMAP_MIN_CELLS = 40 * 40  # maps at least this big are cached on disk, if a cache directory is given
+MMAP_MAX_CELLS = 64 * 64  # the rows of a bigger map are too big to keep, its queries run a BFS bounded by their range
+ROWS_CACHE_SIZE = 1024  # the most rows kept in memory per table
+FILE_MAGIC = b"DIST"
+FILE_HEADER = len(FILE_MAGIC) + 4  # the magic, then the height and width as uint16
+
+
+class DistanceTable:
+    """
+    The shortest water paths from every cell of a map to every other cell, as cell indices (row * width + col)
+    Rows are (the reachable cells in order of distance, their distances)
+    """
+    def __init__(self, height, width, islands):
+        self.height = height
+        self.width = width
+        self.islands = frozenset(islands)
+        self.cells_count = height * width
+        self.cords = [divmod(index, width) for index in range(self.cells_count)]
+        self.neighbors = [self.water_neighbors(index) for index in range(self.cells_count)]
+        self.rows = OrderedDict()  # source cell index: its row, the least recently used first
+        self.rows_lock = threading.Lock()  # the table is shared by the games' actors
+        self.file_view = None  # the memory-mapped rows, when loaded from a file
+
+    def water_neighbors(self, index):
+        row, col = self.cords[index]
+        neighbors = []
+        for d_row, d_col in DIRECTIONS:
+            neighbor = row + d_row, col + d_col
+            if 0 <= neighbor[0] < self.height and 0 <= neighbor[1] < self.width and neighbor not in self.islands:
+                neighbors.append(neighbor[0] * self.width + neighbor[1])
+        return tuple(neighbors)
+
+    def distances_from(self, source, max_distance=None):
+        """
+        Returns the row of the source cell, found by a BFS through the water,
+        only the cells up to max_distance away if it is given
+        """
+        order = array.array('H')
+        distances = array.array('H')
+        if self.cords[source] in self.islands:
+            return order, distances
+        seen = bytearray(self.cells_count)
+        seen[source] = 1
+        order.append(source)
+        distances.append(0)
+        queue = deque([(source, 0)])
+        while queue:
+            curr, distance = queue.popleft()
+            if distance == max_distance:
+                continue
+            for neighbor in self.neighbors[curr]:
+                if not seen[neighbor]:
+                    seen[neighbor] = 1
+                    order.append(neighbor)
+                    distances.append(distance + 1)
+                    queue.append((neighbor, distance + 1))
+        return order, distances
+
+    def row(self, source):
+        if self.file_view is not None:
+            start = source * 2 * self.cells_count
+            return (self.file_view[start:start + self.cells_count],
+                    self.file_view[start + self.cells_count:start + 2 * self.cells_count])
+        with self.rows_lock:
+            row = self.rows.get(source)
+            if row is not None:
+                self.rows.move_to_end(source)
+                return row
+        row = self.distances_from(source)
+        with self.rows_lock:
+            self.rows[source] = row
+            if len(self.rows) > ROWS_CACHE_SIZE:
+                self.rows.popitem(last=False)
+        return row
+
+    def cells_in_range(self, loc, max_range):
+        """
+        Returns the cords of the cells a path of at most max_range moves through the water reaches from loc,
+        nearest first, loc included
+        """
+        source = loc[0] * self.width + loc[1]
+        cords = self.cords
+        if self.file_view is None and self.cells_count > MMAP_MAX_CELLS:
+            order, distances = self.distances_from(source, max_range)
+            return [cords[index] for index in order]
+        order, distances = self.row(source)
+        return [cords[index] for index in order[:bisect.bisect_right(distances, max_range)]]
+
+    def file_name(self):
+        digest = hashlib.sha1(repr(sorted(self.islands)).encode('utf-8')).hexdigest()[:16]
+        return f"distances-{self.height}x{self.width}-{digest}.bin"
+
+    def save(self, path):
+        """
+        Computes every row and writes them to the file, each row padded to the number of cells
+        """
+        with open(path + ".tmp", "wb") as table_file:
+            table_file.write(FILE_MAGIC + array.array('H', [self.height, self.width]).tobytes())
+            for source in range(self.cells_count):
+                order, distances = self.row(source)
+                padding = self.cells_count - len(order)
+                table_file.write((order + array.array('H', [0] * padding)).tobytes())
+                table_file.write((distances + array.array('H', [UNREACHABLE] * padding)).tobytes())
+        os.replace(path + ".tmp", path)
+
+    def load(self, path):
+        """
+        Memory-maps the rows saved to the file, returns False if the file is missing or of another map
+        """
+        try:
+            with open(path, "rb") as table_file:
+                file_map = mmap.mmap(table_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        header = array.array('H', file_map[len(FILE_MAGIC):FILE_HEADER])
+        if file_map[:len(FILE_MAGIC)] != FILE_MAGIC or tuple(header) != (self.height, self.width) \
+                or len(file_map) != FILE_HEADER + 4 * self.cells_count ** 2:
+            file_map.close()
+            return False
+        self.file_view = memoryview(file_map)[FILE_HEADER:].cast('H')
+        self.rows = None
+        return True
+
+
+tables = {}  # (height, width, islands): the map's table
+tables_lock = threading.Lock()
+
+
+def get_table(height, width, islands, cache_dir=None):
+    """
+    Returns the distance table of the map, shared by all the games on it
+    The tables of big maps are loaded from cache_dir, or computed and saved there if they aren't yet
+    """
+    key = height, width, frozenset(islands)
+    with tables_lock:
+        table = tables.get(key)
+        if table is None:
+            table = tables[key] = DistanceTable(height, width, islands)
+            if cache_dir and MMAP_MIN_CELLS <= table.cells_count <= MMAP_MAX_CELLS:
+                path = os.path.join(cache_dir, table.file_name())
+                if not table.load(path):
+                    table.save(path)
+                    table.load(path)
+    return table
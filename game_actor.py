@@ -0,0 +1,69 @@
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from broadcast import Broadcast
+from metrics import metrics
+
+
+class GameActor:
+    """
+    Owns one game and applies every command to it in order, one at a time
+    Connections submit commands and get futures of their results instead of touching the game,
+    so the game has a single writer and needs no locks.
+    The commands are run on a thread pool shared by many games, but a game is never run by two threads at once.
+    """
+    def __init__(self, game, executor):
+        self.game = game
+        self.executor = executor
+        self.mailbox = deque()
+        self.lock = threading.Lock()
+        self.is_scheduled = False  # True while a pool thread is draining the mailbox
+        game.timers.run = self.submit  # the game's timers change it in order with the commands
+        self.broadcast = Broadcast(game, self.submit)
+
+    def submit(self, func, *args):
+        """
+        Queues func(*args) to run on the game's executor and returns a future of its result
+        """
+        future = Future()
+        with self.lock:
+            self.mailbox.append((future, func, args, time.perf_counter()))
+            if not self.is_scheduled:
+                self.is_scheduled = True
+                self.executor.submit(self.drain)
+        return future
+
+    def call(self, func, *args):
+        """
+        Runs func(*args) on the game's executor and waits for its result
+        """
+        return self.submit(func, *args).result()
+
+    def drain(self):
+        """
+        Runs the queued commands until the mailbox is empty
+        """
+        while True:
+            with self.lock:
+                if not self.mailbox:
+                    self.is_scheduled = False
+                    return
+                future, func, args, submit_time = self.mailbox.popleft()
+            metrics.observe("actor_wait_seconds", time.perf_counter() - submit_time)
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+
+    def stop(self):
+        """
+        Cancels the game's timers once the game is torn down
+        """
+        self.submit(self.game.timers.cancel_all)
+
+
+def create_executor(max_workers=None):
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="game")
@@ -1,72 +1,145 @@
 
+import time
 import config
 import player
 import submarine
-import time
+import timers
+from game_map import load_map
+from collections import namedtuple
 from common import PlayerRole, Team, ActionType
 
 
+# a view is what one role of one team sees, player states are built per view
+ALL_VIEWS = tuple((team, role) for team in Team for role in PlayerRole)
+CAPTAIN_VIEWS = tuple((team, PlayerRole.CAPTAIN) for team in Team)
+VALID_TEAMS = frozenset(Team)
+VALID_ROLES = frozenset(PlayerRole)
+
+
 class Game:
-    def __init__(self):
+    def __init__(self, game_map=None):
         self.players = []
-        self.submarines = [submarine.Submarine(Team.BLUE), submarine.Submarine(Team.YELLOW)]
-        self.board = []
-        self.is_stopped = False
-        self.power_in_action = None
-        for row in range(config.BOARD_HEIGHT):
-            curr_row = []
-            for col in  range(config.BOARD_WIDTH):
-                new_cell = Cell(row,col, self.is_island_in_alpha_map(row, col))
-                curr_row.append(new_cell)
-            self.board.append(curr_row)
+        self.version = 0
+        self.view_versions = {view: 0 for view in ALL_VIEWS}  # the game version each view last changed at
+        self.changed_at = None  # perf_counter time of the last change, pushes' latency is measured from it
+        self.subscribers = {view: [] for view in ALL_VIEWS}
+        self.timers = timers.TimerGroup()  # paused while the game is stopped
+        self.map = game_map or load_map(config.DEFAULT_MAP)
+        self.distances = self.map.distances
+        self.masks = self.map.masks
+        self._is_stopped = False
+        self._power_in_action = None
+        self.submarines = [submarine.Submarine(Team.BLUE, self.map), submarine.Submarine(Team.YELLOW, self.map)]
+        for curr_submarine in self.submarines:
+            curr_submarine.on_change = self.changed
+            curr_submarine.timers = self.timers
+
+    def changed(self, views=ALL_VIEWS):
+        """
+        Publishes a change to the game: bumps the game version and the versions of the affected views,
+        and calls the callbacks subscribed to them
+        """
+        self.version += 1
+        self.changed_at = time.perf_counter()
+        for view in views:
+            self.view_versions[view] = self.version
+            for callback in tuple(self.subscribers[view]):
+                callback()
+
+    def subscribe(self, view, callback):
+        """
+        Calls the callback whenever the view, a (team, role) tuple, changes
+        """
+        self.subscribers[view].append(callback)
+
+    def unsubscribe(self, view, callback):
+        self.subscribers[view].remove(callback)
+
+    @property
+    def is_stopped(self):
+        return self._is_stopped
+
+    @is_stopped.setter
+    def is_stopped(self, is_stopped):
+        self._is_stopped = is_stopped
+        if is_stopped:
+            self.timers.pause()
+        else:
+            self.timers.resume()
+        self.changed()
 
-    def add_new_player(self, new_player_team, new_player_role):
-        new_player = None
-        if new_player_role == PlayerRole.CAPTAIN:
-            new_player = player.CaptainPlayer(new_player_team, new_player_role, self.submarines[new_player_team])
-        elif new_player_role == PlayerRole.FIRST_MATE:
-            new_player = player.FirstMatePlayer(new_player_team, new_player_role, self.submarines[new_player_team])
-        elif new_player_role == PlayerRole.ENGINEER:
-            new_player = player.EngineerPlayer(new_player_team, new_player_role, self.submarines[new_player_team])
-        elif new_player_role == PlayerRole.RADIO_OPERATOR:
-            new_player = player.RadioOperatorPlayer(new_player_team, new_player_role, self.submarines[new_player_team])
+    @property
+    def power_in_action(self):
+        return self._power_in_action
+
+    @power_in_action.setter
+    def power_in_action(self, power_in_action):
+        self._power_in_action = power_in_action
+        self.changed(CAPTAIN_VIEWS)
 
+    def add_new_player(self, new_player_team, new_player_role):
+        """
+        Returns the new player, or None if there is no such team or role
+        """
+        if not self.is_valid_role(new_player_team, new_player_role):
+            return None
+        new_player = self.create_player(new_player_team, new_player_role)
         self.players.append(new_player)
         return new_player
 
-    def bfs(self, start_loc, max_range):
-        q = [start_loc]
-        visited = [start_loc]
-        cords_in_range = []
-        while q:
-            curr = q.pop(0)
-            if abs(curr[0] - start_loc[0]) + abs(curr[1] - start_loc[1]) > max_range \
-                    or self.board[curr[0]][curr[1]].is_island:
-                continue
-            else:
-                cords_in_range.append(curr)
-            for direction_cord in submarine.Submarine.direction_dict.values():
-                neighbor = curr[0] + direction_cord[0], curr[1] + direction_cord[1]
-                if neighbor not in visited:
-                    visited.append(neighbor)
-                    q.append(neighbor)
-
-        return cords_in_range
-
-    @staticmethod
-    def is_island_in_alpha_map(row, col):
-        return (row, col) in [(1,2), (1,6), (1,12), (1,13), (2,2), (2,8), (2,12), (3,8), (6,1), (7,1), (6,3), (7,3), (8,3), (6,6), (7,6), (8,7), (6,8), (8,11), (8,12), (8,13), (12,0), (10,3), (11,2), (13,2), (14,3), (11,7), (13,6), (13,8), (11,11), (12,12), (13,13)]
-
     @staticmethod
-    def in_map(loc):
-        return loc[0] < config.BOARD_HEIGHT and loc[1] < config.BOARD_WIDTH
+    def is_valid_role(team, role):
+        """
+        Returns True if the team and role, as picked by a client, are a Team and a PlayerRole
+        """
+        return isinstance(team, int) and isinstance(role, int) \
+            and team in VALID_TEAMS and role in VALID_ROLES
+
+    def create_player(self, team, role):
+        """
+        Returns a player of the role in the team, without adding it to the game
+        """
+        if role == PlayerRole.CAPTAIN:
+            return player.CaptainPlayer(team, role, self.submarines[team])
+        elif role == PlayerRole.FIRST_MATE:
+            return player.FirstMatePlayer(team, role, self.submarines[team])
+        elif role == PlayerRole.ENGINEER:
+            return player.EngineerPlayer(team, role, self.submarines[team])
+        elif role == PlayerRole.RADIO_OPERATOR:
+            return player.RadioOperatorPlayer(team, role, self.submarines[team])
+        return None
+
+    def is_role_taken(self, team, role):
+        for curr_player in self.players:
+            if curr_player.online and curr_player.role == role and curr_player.team == team:
+                return True
+        return False
 
     @staticmethod
     def reverse_team(team):
         return Team.BLUE if team == Team.YELLOW else Team.YELLOW
 
 
+# the part of a power in action the captains' clients need, detached from the players and submarines
+PowerSnapshot = namedtuple('PowerSnapshot', ['action_type', 'activated_team', 'need_to_act_team',
+                                             'is_need_to_act_captain_show_stop_menu',
+                                             'is_need_to_act_captain_show_board',
+                                             'is_need_to_act_captain_can_resume',
+                                             'activated_captain_msg', 'other_captain_msg'])
+
+
+def is_target(target, cells):
+    """
+    Returns True if the target a client clicked is one of the cells, compared by value so any target is safe
+    """
+    return isinstance(target, tuple) and any(target == cell for cell in cells)
+
+
 class Power:
+    __slots__ = ("activated_captain", "action_type", "need_to_act_team", "is_need_to_act_captain_show_stop_menu",
+                 "is_need_to_act_captain_show_board", "is_need_to_act_captain_can_resume", "activated_captain_msg",
+                 "other_captain_msg")
+
     def __init__(self, activated_captain, action_type=-1, is_need_to_act_captain_show_stop_menu=True,
                  is_need_to_act_captain_can_resume=True):
         self.activated_captain = activated_captain
@@ -90,24 +163,27 @@ class Power:
                 and self.activated_captain_msg == other.activated_captain_msg
                 and self.other_captain_msg == other.other_captain_msg)
 
+    def snapshot(self):
+        return PowerSnapshot(self.action_type, self.activated_captain.team, self.need_to_act_team,
+                             self.is_need_to_act_captain_show_stop_menu, self.is_need_to_act_captain_show_board,
+                             self.is_need_to_act_captain_can_resume, self.activated_captain_msg,
+                             self.other_captain_msg)
+
     @staticmethod
     def resume(game):
         game.is_stopped = False
         game.power_in_action = None
-        for curr_submarine in game.submarines:
-            if curr_submarine.surfacing:
-                curr_submarine.surfacing = time.time()
 
 
 
 class Surface(Power):
+    __slots__ = ()
+
     def __init__(self, activated_captain):
         super().__init__(activated_captain, ActionType.SURFACE)
-        surface_section = Cell.get_cords_section(*activated_captain.submarine.path[-1])
+        surface_section = activated_captain.submarine.map.section_of(activated_captain.submarine.path[-1])
 
-        self.activated_captain.submarine.path = [self.activated_captain.submarine.path[-1]]
-        self.activated_captain.submarine.fix_all_tools()
-        self.activated_captain.submarine.surfacing = time.time()
+        self.activated_captain.submarine.surface()
 
         self.need_to_act_team = Game.reverse_team(self.need_to_act_team)
         self.is_need_to_act_captain_show_stop_menu = False
@@ -117,6 +193,8 @@ class Surface(Power):
         self.other_captain_msg = f"enemy surface in section {surface_section}"
 
 class PlantMine(Power):
+    __slots__ = ()
+
     def __init__(self, activated_captain):
         super().__init__(activated_captain, ActionType.PLANT_MINE)
         self.is_need_to_act_captain_show_stop_menu = False
@@ -125,10 +203,15 @@ class PlantMine(Power):
         self.other_captain_msg = "enemy captain placing a mine"
 
     def board_target_clicked(self, game, target):
-        self.activated_captain.submarine.plant_mine(target)
+        submarine = self.activated_captain.submarine
+        if not is_target(target, submarine.masks.cords(submarine.free_neighbors_mask())):
+            return
+        submarine.plant_mine(target)
         self.resume(game)
 
 class ActivateMine(Power):
+    __slots__ = ()
+
     def __init__(self, activated_captain):
         super().__init__(activated_captain, ActionType.ACTIVATE_MINE)
         self.is_need_to_act_captain_show_stop_menu = False
@@ -137,6 +220,8 @@ class ActivateMine(Power):
         self.other_captain_msg = "enemy captain activating a mine"
 
     def board_target_clicked(self, game, target):
+        if not is_target(target, self.activated_captain.submarine.mines):
+            return
         hp_lost = self.activated_captain.submarine.activate_mine(game, target)
         self.need_to_act_team = Game.reverse_team(self.need_to_act_team)
         self.is_need_to_act_captain_show_stop_menu = False
@@ -144,9 +229,12 @@ class ActivateMine(Power):
         self.is_need_to_act_captain_can_resume = True
         self.activated_captain_msg = "waiting for other captain"
         self.other_captain_msg = f"enemy activated mine at {target} - lost {hp_lost} hp"
+        game.changed(CAPTAIN_VIEWS)
 
 
 class Torpedo(Power):
+    __slots__ = ()
+
     def __init__(self, activated_captain):
         super().__init__(activated_captain, ActionType.TORPEDO)
         self.is_need_to_act_captain_show_stop_menu = False
@@ -155,16 +243,22 @@ class Torpedo(Power):
         self.other_captain_msg = "enemy captain firing a torpedo"
 
     def board_target_clicked(self, game, target):
-        hp_lost = self.activated_captain.submarine.fire_torpedo(game, target)
+        submarine = self.activated_captain.submarine
+        if not is_target(target, game.distances.cells_in_range(submarine.loc, player.TORPEDO_RANGE)):
+            return
+        hp_lost = submarine.fire_torpedo(game, target)
         self.need_to_act_team = Game.reverse_team(self.need_to_act_team)
         self.is_need_to_act_captain_show_stop_menu = False
         self.is_need_to_act_captain_show_board = False
         self.is_need_to_act_captain_can_resume = True
         self.activated_captain_msg = "waiting for other captain"
         self.other_captain_msg = f"enemy fired torpedo to {target} - lost {hp_lost} hp"
+        game.changed(CAPTAIN_VIEWS)
         #TODO: inform the captains is mines have exploded
 
 class Silence(Power):
+    __slots__ = ()
+
     def __init__(self, activated_captain):
         super().__init__(activated_captain, ActionType.SILENCE)
         self.is_need_to_act_captain_show_stop_menu = False
@@ -177,6 +271,8 @@ class Silence(Power):
         self.resume(game)
 
 class Drone(Power):
+    __slots__ = ()
+
     def __init__(self, activated_captain):
         super().__init__(activated_captain, ActionType.DRONE)
         self.is_need_to_act_captain_show_stop_menu = False
@@ -185,7 +281,7 @@ class Drone(Power):
         self.other_captain_msg = "enemy captain activating drone"
 
     def board_target_clicked(self, game, target):
-        target_section = game.board[target[0]][target[1]].section
+        target_section = game.map.section_of(target)
         is_enemy_detected = self.activated_captain.submarine.activate_drone(game, target_section)
         self.is_need_to_act_captain_show_stop_menu = False
         self.is_need_to_act_captain_can_resume = True
@@ -197,8 +293,11 @@ class Drone(Power):
         else:
             self.other_captain_msg += "- did'nt find you"
             self.activated_captain_msg = f"enemy not in section {target_section}"
+        game.changed(CAPTAIN_VIEWS)
 
 class Sonar(Power):
+    __slots__ = ()
+
     def __init__(self, activated_captain):
         super().__init__(activated_captain, ActionType.SONAR)
         self.need_to_act_team = Game.reverse_team(self.need_to_act_team)
@@ -214,16 +313,4 @@ class Sonar(Power):
         self.is_need_to_act_captain_show_stop_menu = False
         self.is_need_to_act_captain_can_resume = True
         self.is_need_to_act_captain_show_board = False
-
-
-class Cell:
-    def __init__(self, row, col, is_island=False):
-        self.row = row
-        self.col = col
-        self.is_island = is_island
-        #self.mines = []
-        self.section = self.get_cords_section(self.row, self.col)
-
-    @staticmethod
-    def get_cords_section(row, col):
-        return (1+ col // 5) + 3 * (row // 5)
\ No newline at end of file
+        game.changed(CAPTAIN_VIEWS)
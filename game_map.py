@@ -0,0 +1,113 @@
+"""
+Maps: the islands, size and sections of a board
+
+A map is defined by a JSON file in the maps directory, its rows drawn with "." for water and "x" for islands,
+or as another map repeated over a bigger board:
+
+    {"name": "alpha", "section_size": 5, "rows": ["...x...", ...]}
+    {"name": "alpha 60x60", "section_size": 10, "tile": "alpha", "height": 60, "width": 60}
+
+A map is compiled once into a GameMap holding its cells, masks and distance table, and shared by all the games
+played on it, so creating a game does no work per cell.
+"""
+import os
+import json
+import array
+import threading
+
+import config
+import bitboard
+import distances
+
+
+MAPS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "maps")
+MAP_FILE_SUFFIX = ".json"
+WATER = "."
+ISLAND = "x"
+DEFAULT_SECTION_SIZE = 5
+
+
+class GameMap:
+    """
+    A compiled map, read only once compiled
+    The cells are stored flat, row by row, in typed arrays of their island flags and section numbers.
+    Sections are section_size x section_size squares numbered from 1, row by row
+    """
+    def __init__(self, name, height, width, islands, section_size=DEFAULT_SECTION_SIZE):
+        self.name = name
+        self.height = height
+        self.width = width
+        self.section_size = section_size
+        self.sections_per_row = -(-width // section_size)
+        self.islands = frozenset(islands)
+        self.island_flags = bytearray(height * width)
+        for row, col in self.islands:
+            self.island_flags[row * width + col] = 1
+        self.sections = array.array('H', (1 + col // section_size + self.sections_per_row * (row // section_size)
+                                          for row in range(height) for col in range(width)))
+        self.masks = bitboard.BoardMasks(height, width, self.islands, section_size)
+        # island-aware distances between the cells, shared with the maps of the same islands
+        self.distances = distances.get_table(height, width, self.islands, config.DISTANCE_CACHE_DIR)
+
+    def in_map(self, loc):
+        return 0 <= loc[0] < self.height and 0 <= loc[1] < self.width
+
+    def is_island(self, loc):
+        return bool(self.island_flags[loc[0] * self.width + loc[1]])
+
+    def section_of(self, loc):
+        return self.sections[loc[0] * self.width + loc[1]]
+
+    def water_cells(self):
+        """
+        Returns the cords of the cells that are not islands, row by row
+        """
+        return [divmod(index, self.width) for index, is_island in enumerate(self.island_flags) if not is_island]
+
+
+def tile_rows(rows, height, width):
+    """
+    Returns the rows repeated over a height x width board
+    """
+    return ["".join(rows[row % len(rows)][col % len(rows[0])] for col in range(width)) for row in range(height)]
+
+
+def parse_map(definition):
+    """
+    Compiles a map definition, raises ValueError if it is malformed
+    """
+    rows = definition.get("rows")
+    if "tile" in definition:
+        with open(os.path.join(MAPS_DIR, definition["tile"] + MAP_FILE_SUFFIX)) as map_file:
+            rows = tile_rows(json.load(map_file)["rows"], definition["height"], definition["width"])
+    if not rows or any(len(row) != len(rows[0]) for row in rows) or set("".join(rows)) - {WATER, ISLAND}:
+        raise ValueError(f"map {definition.get('name')} must have rows of the same length of '{WATER}' and '{ISLAND}'")
+    islands = [(row, col) for row, line in enumerate(rows) for col, char in enumerate(line) if char == ISLAND]
+    return GameMap(definition["name"], len(rows), len(rows[0]), islands,
+                   definition.get("section_size", DEFAULT_SECTION_SIZE))
+
+
+def list_maps():
+    """
+    Returns the names of the maps in the maps directory
+    """
+    return sorted(file_name[:-len(MAP_FILE_SUFFIX)] for file_name in os.listdir(MAPS_DIR)
+                  if file_name.endswith(MAP_FILE_SUFFIX))
+
+
+maps = {}  # name: compiled map
+maps_lock = threading.Lock()
+
+
+def load_map(name):
+    """
+    Returns the compiled map, compiling its file the first time it is loaded
+    Raises KeyError if there is no such map
+    """
+    with maps_lock:
+        if name not in maps:
+            if name not in list_maps():
+                raise KeyError(f"no map named {name}")
+            with open(os.path.join(MAPS_DIR, name + MAP_FILE_SUFFIX)) as map_file:
+                maps[name] = parse_map(json.load(map_file))
+        return maps[name]
@@ -0,0 +1,335 @@
+"""
+Headless load generator and latency benchmark for the server
+
+Plays matches with bots speaking the real protocol: every match has the 8 players of a game,
+the captains move to random possible cells (and surface when stuck), the first mates load powers,
+the engineers brake tools in the moved direction and the radio operators only listen.
+Reports the actions throughput, the p50/p99 latencies of the action replies and of the pushes
+the captains' moves cause to the other players, and the server's CPU and memory use.
+
+    python load_test.py --matches 50 --duration 30 --server-pid 1234
+    python load_test.py --matches 50 --spawn-server --asyncio    # runs the server itself
+    python load_test.py --matches 200 --processes 4              # bots spread over 4 processes
+"""
+import os
+import sys
+import time
+import random
+import socket
+import asyncio
+import argparse
+import subprocess
+import multiprocessing
+
+# developer note: player must be imported from before game_file to avoid circular importing
+from player import State, CaptainBoardDelta
+from network import async_recv_request
+from common import ActionType, PlayerRole, Team
+import protocol
+
+SERVER_START_TIMEOUT = 10  # seconds to wait for a spawned server to accept connections
+
+
+class Match:
+    """
+    The bots of one game and the timing of the captains' moves, shared by the bots to measure push latency
+    """
+    def __init__(self, index):
+        self.index = index
+        self.game_id = None
+        self.bots = []
+        self.move_ids = {team: 0 for team in Team}
+        self.move_times = {team: None for team in Team}
+
+    def captain_moved(self, team):
+        self.move_ids[team] += 1
+        self.move_times[team] = time.perf_counter()
+
+
+class Stats:
+    def __init__(self):
+        self.actions = 0
+        self.pushes = 0
+        self.reply_latencies = []
+        self.push_latencies = []
+        self.errors = 0
+
+    def merge(self, other):
+        self.actions += other.actions
+        self.pushes += other.pushes
+        self.reply_latencies += other.reply_latencies
+        self.push_latencies += other.push_latencies
+        self.errors += other.errors
+
+
+class Bot:
+    """
+    One simulated client playing one role
+    """
+    def __init__(self, match, team, role, stats, think_time):
+        self.match = match
+        self.team = team
+        self.role = role
+        self.stats = stats
+        self.think_time = think_time
+        self.reader = None
+        self.writer = None
+        self.next_request_id = 1
+        self.replies = {}  # request id: future of the reply
+        self.state = None
+        self.state_changed = asyncio.Event()
+        self.seen_move_ids = {team: 0 for team in Team}
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        asyncio.create_task(self.receive())
+
+    async def request(self, msg):
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        reply = self.replies[request_id] = asyncio.get_running_loop().create_future()
+        self.writer.write(protocol.encode(msg, request_id))
+        try:
+            return await reply
+        finally:
+            self.replies.pop(request_id, None)
+
+    async def receive(self):
+        """
+        Applies the states the server sends, replies and pushes alike, in the order they arrive,
+        so a captain board delta always lands on the board it was diffed from
+        """
+        try:
+            while True:
+                request_id, msg = await async_recv_request(self.reader)
+                if request_id == protocol.PUSH_ID:
+                    self.stats.pushes += 1
+                    self.measure_push_latency()
+                    self.update_state(msg)
+                elif request_id in self.replies:
+                    if isinstance(msg, (State, CaptainBoardDelta)):
+                        self.update_state(msg)
+                    self.replies[request_id].set_result(msg)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            for reply in self.replies.values():
+                reply.cancel()
+
+    def measure_push_latency(self):
+        """
+        The first push after a captain's move to a player it affects is counted as the move's push
+        """
+        teams = [self.team] if self.role in (PlayerRole.ENGINEER, PlayerRole.FIRST_MATE) else []
+        if self.role == PlayerRole.RADIO_OPERATOR:
+            teams = [team for team in Team if team != self.team]
+        for team in teams:
+            move_id = self.match.move_ids[team]
+            if move_id != self.seen_move_ids[team] and self.match.move_times[team]:
+                self.seen_move_ids[team] = move_id
+                self.stats.push_latencies.append(time.perf_counter() - self.match.move_times[team])
+
+    def update_state(self, msg):
+        if isinstance(msg, CaptainBoardDelta):
+            msg = msg.apply(self.state)
+        self.state = msg
+        self.state_changed.set()
+
+    async def join(self):
+        if self.match.game_id is None:
+            self.match.game_id = await self.request(f"lobby create load {self.match.index}")
+        else:
+            await self.request(f"lobby join {self.match.game_id}")
+        reply = await self.request((self.team, self.role))
+        if reply != "role accepted":
+            raise RuntimeError(f"joining game {self.match.game_id} as {self.team.name} {self.role.name}: {reply}")
+        await self.request("get")  # the state is applied as it is received
+
+    async def play(self, end_time):
+        while time.perf_counter() < end_time:
+            try:
+                await asyncio.wait_for(self.state_changed.wait(), end_time - time.perf_counter())
+            except asyncio.TimeoutError:
+                return
+            self.state_changed.clear()
+            await asyncio.sleep(random.uniform(0, 2 * self.think_time))
+            action = self.next_action()
+            if action is None:
+                continue
+            start = time.perf_counter()
+            if self.role == PlayerRole.CAPTAIN and isinstance(action, tuple):
+                self.match.captain_moved(self.team)
+            await self.request(action)  # the reply's state is applied as it is received
+            self.stats.reply_latencies.append(time.perf_counter() - start)
+            self.stats.actions += 1
+
+    def next_action(self):
+        if not self.state or not self.state.can_act:
+            return None
+        if self.role == PlayerRole.CAPTAIN:
+            return self.next_captain_action()
+        if self.role == PlayerRole.FIRST_MATE:
+            powers = [i for i, (charge, max_charge) in enumerate(self.state.powers_charges) if charge < max_charge]
+            return ("first mate clicked power", random.choice(powers)) if powers else None
+        if self.role == PlayerRole.ENGINEER:
+            tools = [cords for cords, status in self.state.tools_state if status == "y"]
+            return ("engineer clicked tool", random.choice(tools)) if tools else None
+        return None
+
+    def next_captain_action(self):
+        power = self.state.power_in_action
+        if power:
+            if power.need_to_act_team == self.team and power.is_need_to_act_captain_can_resume:
+                return "captain resume"
+            return None
+        cells = [divmod(i, self.state.board_width) for i, char in enumerate(self.state.board_str) if char == "y"]
+        if cells:
+            return "captain clicked loc", random.choice(cells)
+        if not self.state.is_game_stopped:
+            return f"captain submitted {ActionType.SURFACE}"
+        return None
+
+
+async def run_matches(first_match, matches_count, host, port, duration, think_time):
+    stats = Stats()
+    matches = [Match(first_match + i) for i in range(matches_count)]
+    for match in matches:
+        for team in Team:
+            for role in PlayerRole:
+                bot = Bot(match, team, role, stats, think_time)
+                await bot.connect(host, port)
+                await bot.join()
+                match.bots.append(bot)
+    end_time = time.perf_counter() + duration
+    results = await asyncio.gather(*[bot.play(end_time) for match in matches for bot in match.bots],
+                                   return_exceptions=True)
+    stats.errors = len([result for result in results if isinstance(result, BaseException)])
+    for match in matches:
+        for bot in match.bots:
+            bot.writer.close()
+    return stats
+
+
+def run_process(first_match, matches_count, host, port, duration, think_time):
+    return asyncio.run(run_matches(first_match, matches_count, host, port, duration, think_time))
+
+
+def process_tree(pid):
+    """
+    Returns the pid and the pids of all of the process's descendants
+    """
+    pids = [pid]
+    for task in os.listdir(f"/proc/{pid}/task"):
+        try:
+            with open(f"/proc/{pid}/task/{task}/children") as children:
+                for child in children.read().split():
+                    pids += process_tree(int(child))
+        except OSError:
+            pass
+    return pids
+
+
+def process_usage(pid):
+    """
+    Returns the CPU seconds used and the resident memory in bytes of the process and its descendants (linux only)
+    """
+    cpu_time = 0
+    memory = 0
+    for curr_pid in process_tree(pid):
+        try:
+            with open(f"/proc/{curr_pid}/stat") as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+            cpu_time += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')  # utime + stime
+            memory += int(fields[21]) * os.sysconf('SC_PAGE_SIZE')  # rss
+        except OSError:
+            pass
+    return cpu_time, memory
+
+
+def port_answers(host, port):
+    """Returns True if something accepts connections on the port"""
+    try:
+        socket.create_connection((host, port), timeout=1).close()
+        return True
+    except OSError:
+        return False
+
+
+def wait_for_server(server_process, host, port, timeout=SERVER_START_TIMEOUT):
+    """Returns True once the spawned server accepts connections, False if it exited or never answered"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server_process.poll() is not None:
+            return False
+        if port_answers(host, port):
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--matches", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=30, help="seconds of play after all bots joined")
+    parser.add_argument("--think-time", type=float, default=0.05, help="mean seconds a bot waits before acting")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7777)
+    parser.add_argument("--server-pid", type=int, help="the server to report the CPU and memory use of")
+    parser.add_argument("--spawn-server", action="store_true", help="run server.py for the test")
+    parser.add_argument("--asyncio", action="store_true", help="run the spawned server with --asyncio")
+    args = parser.parse_args()
+
+    server_process = None
+    if args.spawn_server:
+        if port_answers(args.host, args.port):
+            sys.exit(f"{args.host}:{args.port} is already taken, stop its server or pass --server-pid instead")
+        server_process = subprocess.Popen([sys.executable, "server.py"] + (["--asyncio"] if args.asyncio else []),
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        args.server_pid = server_process.pid
+        if not wait_for_server(server_process, args.host, args.port):
+            server_process.kill()
+            sys.exit(f"the spawned server did not start on {args.host}:{args.port} "
+                     f"(exit code {server_process.poll()})")
+
+    try:
+        usage_before = process_usage(args.server_pid) if args.server_pid else None
+        start = time.perf_counter()
+        per_process = [args.matches // args.processes + (i < args.matches % args.processes)
+                       for i in range(args.processes)]
+        jobs = [(sum(per_process[:i]), count, args.host, args.port, args.duration, args.think_time)
+                for i, count in enumerate(per_process) if count]
+        if len(jobs) == 1:
+            results = [run_process(*jobs[0])]
+        else:
+            with multiprocessing.Pool(len(jobs)) as pool:
+                results = pool.starmap(run_process, jobs)
+        elapsed = time.perf_counter() - start
+        usage_after = process_usage(args.server_pid) if args.server_pid else None
+    finally:
+        if server_process:
+            server_process.kill()
+
+    stats = Stats()
+    for result in results:
+        stats.merge(result)
+    print(f"matches: {args.matches}, players: {8 * args.matches}, play time: {args.duration}s")
+    print(f"actions: {stats.actions} ({stats.actions / args.duration:.1f}/s), "
+          f"pushes: {stats.pushes} ({stats.pushes / args.duration:.1f}/s), bot errors: {stats.errors}")
+    print(f"action reply latency: p50 {1000 * percentile(stats.reply_latencies, 0.5):.2f}ms, "
+          f"p99 {1000 * percentile(stats.reply_latencies, 0.99):.2f}ms")
+    print(f"move to push latency: p50 {1000 * percentile(stats.push_latencies, 0.5):.2f}ms, "
+          f"p99 {1000 * percentile(stats.push_latencies, 0.99):.2f}ms")
+    if usage_before and usage_after:
+        cpu_time = usage_after[0] - usage_before[0]
+        print(f"server CPU: {cpu_time:.2f}s ({100 * cpu_time / elapsed:.1f}% of one core), "
+              f"memory: {usage_after[1] / 2 ** 20:.1f}MiB")
+
+
+if __name__ == '__main__':
+    main()
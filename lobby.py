@@ -0,0 +1,160 @@
+import threading
+
+from game_file import Game
+from game_map import load_map, list_maps
+from game_actor import GameActor, create_executor
+from timers import scheduler
+
+
+DEFAULT_GAME_NAME = "default"
+EMPTY_GAME_TIMEOUT = 5 * 60  # seconds a new game may wait for its first player before it is torn down
+
+
+class Lobby:
+    """
+    Hosts many concurrent games in one server process
+    Every game owns its own players, submarines and power in action,
+    the lobby only routes connections to them by game id.
+    All changes to a game go through its GameActor, the games' actors share one thread pool
+    """
+    def __init__(self, max_workers=None, game_id_prefix=""):
+        self.game_id_prefix = game_id_prefix  # makes game ids unique across server processes
+        self.games = {}
+        self.actors = {}
+        self.names = {}
+        self.next_game_id = 1
+        self.lock = threading.Lock()
+        self.executor = create_executor(max_workers)
+
+    def create_game(self, name=None, map_name=None):
+        """
+        Creates a new game on the map (the default map if None) and returns its id
+        Raises KeyError if there is no such map
+        """
+        game_map = load_map(map_name) if map_name else None
+        with self.lock:
+            return self.add_game(name, game_map)
+
+    def add_game(self, name, game_map):
+        """
+        Creates a new game and returns its id, called with self.lock held
+        """
+        game_id = f"{self.game_id_prefix}{self.next_game_id}"
+        self.next_game_id += 1
+        game = Game(game_map)
+        self.games[game_id] = game
+        self.actors[game_id] = GameActor(game, self.executor)
+        self.names[game_id] = name or f"game {game_id}"
+        scheduler.call_later(EMPTY_GAME_TIMEOUT, self.expire_game, game_id)
+        return game_id
+
+    def expire_game(self, game_id):
+        """
+        Tears down the game if nobody is playing it, like a game created by a client that left without joining it
+        Runs on the game's actor, so no player joins in between
+        """
+        actor = self.get_actor(game_id)
+        if actor:
+            actor.submit(self.remove_game_if_empty, game_id, actor.game)
+
+    def remove_game_if_empty(self, game_id, game):
+        if not any(curr_player.online for curr_player in game.players):
+            self.remove_game(game_id)
+
+    def get_game(self, game_id):
+        return self.games.get(game_id)
+
+    def get_actor(self, game_id):
+        return self.actors.get(game_id)
+
+    def get_default_game_id(self, create=True):
+        """
+        Returns the id of the game joined by clients that did not pick a game,
+        creating it if needed (or returning None if create is False)
+        """
+        with self.lock:  # looked up and created at once, so concurrent clients can't create two default games
+            for game_id, name in self.names.items():
+                if name == DEFAULT_GAME_NAME:
+                    return game_id
+            return self.add_game(DEFAULT_GAME_NAME, None) if create else None
+
+    def list_games(self):
+        """
+        Returns a list of (game id, name, online players count) of all games
+        """
+        with self.lock:
+            return [(game_id, self.names[game_id], len([player for player in game.players if player.online]))
+                    for game_id, game in self.games.items()]
+
+    def join(self, game_id, team, role):
+        """
+        Adds a player to the game if the role is not taken
+        Returns the new player, or None if the game does not exist or the role is taken
+        """
+        actor = self.get_actor(game_id)
+        if not actor:
+            return None
+        return actor.call(self.join_game, game_id, actor.game, team, role)
+
+    def join_game(self, game_id, game, team, role):
+        if self.games.get(game_id) is not game:  # torn down since the actor was looked up
+            return None
+        if game.is_role_taken(team, role):
+            return None
+        return game.add_new_player(team, role)
+
+    def leave(self, game_id, player):
+        """
+        Disconnects the player and tears down the game once no player is online
+        Returns True if the game was torn down
+        """
+        actor = self.get_actor(game_id)
+        if actor and not actor.call(self.leave_game, actor.game, player):
+            self.remove_game(game_id)
+            return True
+        return False
+
+    @staticmethod
+    def leave_game(game, player):
+        """
+        Returns True if players are still online
+        """
+        player.disconnected()
+        return any(curr_player.online for curr_player in game.players)
+
+    def remove_game(self, game_id):
+        with self.lock:
+            self.games.pop(game_id, None)
+            self.names.pop(game_id, None)
+            actor = self.actors.pop(game_id, None)
+        if actor:
+            actor.stop()
+
+    def handle_lobby_command(self, data):
+        """
+        Handles a "lobby ..." command sent before the client picks a role
+        Returns the reply for the client and the id of the game it joined, if any
+        """
+        command = data.split(' ', 2)
+        if len(command) < 2:
+            return "unknown command", None
+        if command[1] == "list":
+            return self.list_games(), None
+        elif command[1] == "maps":
+            return list_maps(), None
+        elif command[1] == "create":
+            game_id = self.create_game(command[2] if len(command) > 2 else None)
+            return game_id, game_id
+        elif command[1] == "create_on_map":  # lobby create_on_map <map> [name]
+            map_name, _, name = command[2].partition(' ') if len(command) > 2 else (None, None, None)
+            try:
+                game_id = self.create_game(name or None, map_name)
+            except KeyError:
+                return "no such map", None
+            return game_id, game_id
+        elif command[1] == "join":
+            game_id = command[2] if len(command) > 2 else None
+            if game_id in self.games:
+                return "joined", game_id
+            return "no such game", None
+        return "unknown command", None
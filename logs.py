@@ -0,0 +1,32 @@
+"""
+Levelled logging for the server
+
+The per message logs are at DEBUG level and sampled: only one of every sample_every of them is written,
+so turning them on doesn't slow the server down as much as printing every frame did.
+"""
+import logging
+import itertools
+
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+DEFAULT_SAMPLE_EVERY = 100
+
+
+class SampleFilter(logging.Filter):
+    """
+    Lets through one of every sample_every DEBUG records, records of higher levels always pass
+    """
+    def __init__(self, sample_every):
+        super().__init__()
+        self.sample_every = sample_every
+        self.counter = itertools.count()
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or next(self.counter) % self.sample_every == 0
+
+
+def setup_logging(level="INFO", sample_every=DEFAULT_SAMPLE_EVERY):
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handler.addFilter(SampleFilter(sample_every))
+    logging.basicConfig(level=level.upper(), handlers=[handler])
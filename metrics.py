@@ -0,0 +1,141 @@
+"""
+Server instrumentation: counters, histograms and gauges, served as JSON over HTTP and dumped to a file
+
+    python server.py --asyncio --stats-port 7778 --stats-file stats.json
+    curl localhost:7778/stats
+"""
+import os
+import json
+import time
+import bisect
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+HISTOGRAM_BOUNDS = [1e-6 * 2 ** i for i in range(25)]  # 1us to ~17s, the upper bounds of the buckets
+DEFAULT_DUMP_INTERVAL = 10  # seconds
+
+class Histogram:
+    """
+    Counts observed values in exponential buckets, percentiles are the upper bounds of their buckets
+    """
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(HISTOGRAM_BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(HISTOGRAM_BOUNDS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def snapshot(self):
+        return {"count": self.count,
+                "mean": self.total / self.count if self.count else 0,
+                "p50": self.percentile(0.5),
+                "p90": self.percentile(0.9),
+                "p99": self.percentile(0.99),
+                "max": self.max}
+
+
+class Metrics:
+    """
+    Thread safe registry of named counters, histograms and gauges
+    Gauges are functions called when a snapshot is taken
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+        self.gauges = {}
+        self.start_time = time.time()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name, value):
+        with self.lock:
+            self.histograms[name].observe(value)
+
+    def gauge(self, name, func):
+        self.gauges[name] = func
+
+    def message_in(self, msg_type_name, frame_len, decode_time):
+        with self.lock:
+            self.counters[f"messages_in.{msg_type_name}"] += 1
+            self.counters["bytes_in"] += frame_len
+            self.histograms["decode_seconds"].observe(decode_time)
+
+    def message_out(self, msg_type_name, frame_len, encode_time=None):
+        """
+        Counts a frame sent, encode_time is None for frames encoded once and sent to many clients
+        """
+        with self.lock:
+            self.counters[f"messages_out.{msg_type_name}"] += 1
+            self.counters["bytes_out"] += frame_len
+            if encode_time is not None:
+                self.histograms["encode_seconds"].observe(encode_time)
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = {"time": time.time(),
+                        "uptime": time.time() - self.start_time,
+                        "counters": dict(self.counters),
+                        "histograms": {name: histogram.snapshot() for name, histogram in self.histograms.items()}}
+        snapshot["gauges"] = {name: func() for name, func in self.gauges.items()}
+        return snapshot
+
+
+metrics = Metrics()
+
+
+class StatsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/stats"):
+            self.send_error(404)
+            return
+        body = json.dumps(metrics.snapshot(), indent=2).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stats_server(port, host="127.0.0.1"):
+    """
+    Serves the metrics as JSON on http://host:port/stats from a background thread
+    """
+    stats_server = ThreadingHTTPServer((host, port), StatsHandler)
+    threading.Thread(target=stats_server.serve_forever, name="stats", daemon=True).start()
+    return stats_server
+
+
+def start_dump(path, interval=DEFAULT_DUMP_INTERVAL):
+    """
+    Writes the metrics as JSON to the file every interval seconds from a background thread
+    """
+    def dump():
+        while True:
+            time.sleep(interval)
+            with open(path + ".tmp", "w") as stats_file:
+                json.dump(metrics.snapshot(), stats_file, indent=2)
+            os.replace(path + ".tmp", path)
+
+    threading.Thread(target=dump, name="stats dump", daemon=True).start()
@@ -1,12 +1,33 @@
+import time
 import socket
-import pickle
+import logging
+from collections import deque
+
+from metrics import metrics
+import protocol
+
+log = logging.getLogger(__name__)
+
+# receive without blocking in a single call where the platform supports it
+DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
 
 class Network:
+    """
+    Client side connection to the server
+    Requests carry an id so several can be in flight; each reply is matched to its request,
+    and states the server pushes on its own are delivered separately, to push_handler or to listen()
+    """
     def __init__(self):
         self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server = "127.0.0.1"
         self.port = 7777
         self.addr = (self.server, self.port)
+        self.reader = FrameReader(self.client)
+        self.next_request_id = 1
+        self.reply_callbacks = {}  # request id -> callback called with the reply, None to keep the reply
+        self.replies = {}
+        self.pushes = deque()
+        self.push_handler = None  # called with every push in arrival order, if not set pushes are queued
         self.connect()
 
 
@@ -16,59 +37,247 @@ class Network:
         except Exception as e:
             raise e
 
+    def request(self, data, callback=None):
+        """
+        Sends a request without waiting for the reply
+        The reply is passed to the callback when polled, or kept for wait_reply if there is no callback
+        Returns the request id
+        """
+        request_id = self.next_request_id
+        self.next_request_id = self.next_request_id % protocol.MAX_REQUEST_ID + 1
+        self.reply_callbacks[request_id] = callback
+        send_msg(self.client, data, request_id)
+        return request_id
+
+    def wait_reply(self, request_id):
+        """
+        Handles incoming frames until the reply to the request arrives and returns it
+        """
+        while request_id not in self.replies:
+            self.handle_frame(blocking=True)
+        return self.replies.pop(request_id)
+
     def send(self, data):
+        """
+        Sends a request and waits for its reply
+        """
         try:
-            send_msg(self.client, data)
-            got = self.listen()
-            print('got:', got)
+            got = self.wait_reply(self.request(data))
+            log.debug('got: %s', got)
             return got
         except socket.error as e:
-            print(e)
+            log.warning(e)
 
     def only_send(self, data):
+        """
+        Sends a request, its reply is dropped
+        """
         try:
-            send_msg(self.client, data)
+            self.request(data, callback=lambda reply: None)
 
         except socket.error as e:
-            print(e)
+            log.warning(e)
+
+    def poll(self):
+        """
+        Handles all frames that already arrived without blocking
+        """
+        try:
+            while self.handle_frame(blocking=False):
+                pass
+        except socket.error as e:
+            log.warning(e)
+
+    def handle_frame(self, blocking=True):
+        """
+        Receives one frame and delivers it to its request's callback or to the pushes
+        Returns False if not blocking and no frame arrived
+        """
+        request = self.reader.recv_request(blocking)
+        if not request:
+            return False
+        request_id, got = request
+        if request_id == protocol.PUSH_ID:
+            if self.push_handler:
+                self.push_handler(got)
+            else:
+                self.pushes.append(got)
+        else:
+            callback = self.reply_callbacks.pop(request_id, None)
+            if callback:
+                callback(got)
+            else:
+                self.replies[request_id] = got
+        return True
 
     def listen(self, blocking=True):
+        """
+        Returns the next state pushed by the server, or None if not blocking and nothing was pushed
+        """
         try:
-            got = recv(self.client, blocking)
-            if got:
-                print('got:', got)
+            while not self.pushes:
+                if not self.handle_frame(blocking):
+                    return None
+            got = self.pushes.popleft()
+            log.debug('got: %s', got)
             return got
 
-        except BlockingIOError:
-            pass
         except socket.error as e:
-            print(e)
+            log.warning(e)
 
     def close(self):
         self.client.close()
 
 
-def get_len(msg):
-    return str(len(msg)).ljust(20)
-
-def send_msg(conn, msg):
-    print('send:', msg)
-    msg_b = pickle.dumps(msg)
-    len_msg = get_len(msg_b).encode('utf-8')
-    conn.sendall(len_msg + msg_b)
-
-def recv(conn, blocking=True):
-    try:
-        conn.setblocking(blocking)
-        msg_len = int(conn.recv(20))
-        recved = b""
-        while len(recved) < msg_len:
-            recved = recved + conn.recv(msg_len-len(recved))
-        ret = pickle.loads(recved)
-        conn.setblocking(True)
-        return ret
-    except BlockingIOError:
-        conn.setblocking(True)
+def encode_msg(msg, request_id):
+    """
+    Returns the frame of the message, counted in the metrics
+    """
+    log.debug('send: %s', msg)
+    start = time.perf_counter()
+    frame = protocol.encode(msg, request_id)
+    count_frame_out(frame, time.perf_counter() - start)
+    return frame
+
+def count_frame_out(frame, encode_time=None):
+    metrics.message_out(protocol.MSG_TYPE_NAMES.get(frame[1], str(frame[1])), len(frame), encode_time)
+
+def decode_msg(msg_type, payload):
+    """
+    Returns the message of a frame's payload, counted in the metrics
+    """
+    start = time.perf_counter()
+    msg = protocol.decode(msg_type, payload)
+    metrics.message_in(protocol.MSG_TYPE_NAMES.get(msg_type, str(msg_type)), protocol.HEADER.size + len(payload),
+                       time.perf_counter() - start)
+    return msg
+
+def send_msg(conn, msg, request_id=protocol.PUSH_ID):
+    conn.sendall(encode_msg(msg, request_id))
+
+class FrameReader:
+    """
+    Reads the frames of one connection into a preallocated buffer
+    A single recv_into can bring in several frames, which are then handed out without another syscall,
+    and frames are handed out as memoryviews into the buffer instead of copies
+    """
+    def __init__(self, conn, buffer_size=64 * 1024):
+        self.conn = conn
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # start of the received data that was not handed out yet
+        self.end = 0  # end of the received data
+
+    def fill(self, blocking=True):
+        """
+        Receives whatever is available into the free end of the buffer
+        Returns False if not blocking and nothing is available
+        """
+        if self.end == len(self.buffer):
+            self.make_room(len(self.buffer) - self.start + 1)
+        try:
+            if blocking:
+                recved_len = self.conn.recv_into(self.view[self.end:])
+            elif DONTWAIT:
+                recved_len = self.conn.recv_into(self.view[self.end:], 0, DONTWAIT)
+            else:
+                self.conn.setblocking(False)
+                try:
+                    recved_len = self.conn.recv_into(self.view[self.end:])
+                finally:
+                    self.conn.setblocking(True)
+        except BlockingIOError:
+            return False
+        if not recved_len:
+            raise ConnectionError("connection closed")
+        self.end += recved_len
+        return True
+
+    def make_room(self, frame_len):
+        """
+        Makes sure a frame of frame_len bytes starting at self.start fits in the buffer,
+        moving the unread data to the front or growing the buffer if it doesn't
+        """
+        if self.start + frame_len <= len(self.buffer):
+            return
+        unread_len = self.end - self.start
+        if frame_len > len(self.buffer):
+            new_buffer = bytearray(max(frame_len, 2 * len(self.buffer)))
+            new_buffer[:unread_len] = self.view[self.start:self.end]
+            self.buffer = new_buffer
+            self.view = memoryview(self.buffer)
+        else:
+            self.buffer[:unread_len] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = unread_len
+
+    def next_frame(self):
+        """
+        Returns the message type, request id and payload of the next frame if it was fully received, otherwise None
+        The payload is a view into the buffer and is only valid until the next read
+        """
+        if self.start == self.end:
+            self.start = self.end = 0
+            return None
+        if self.end - self.start < protocol.HEADER.size:
+            self.make_room(protocol.HEADER.size)
+            return None
+        msg_type, request_id, payload_len = protocol.decode_header(self.view[self.start:
+                                                                             self.start + protocol.HEADER.size])
+        frame_len = protocol.HEADER.size + payload_len
+        if self.end - self.start < frame_len:
+            self.make_room(frame_len)
+            return None
+        payload = self.view[self.start + protocol.HEADER.size:self.start + frame_len]
+        self.start += frame_len
+        return msg_type, request_id, payload
+
+    def read_frame(self, blocking=True):
+        """
+        Returns the next frame, or None if not blocking and it was not fully received yet
+        Once part of a frame arrived, waits for the rest of it even if not blocking
+        """
+        frame = self.next_frame()
+        while not frame:
+            if not self.fill(blocking or self.start != self.end):
+                return None
+            frame = self.next_frame()
+        return frame
+
+    def unread(self):
+        """
+        Returns a copy of the data that was received but not handed out yet
+        """
+        return bytes(self.view[self.start:self.end])
+
+    def recv_request(self, blocking=True):
+        """
+        Returns the request id and message of the next frame, or None if not blocking and no message arrived
+        """
+        frame = self.read_frame(blocking)
+        if frame:
+            msg_type, request_id, payload = frame
+            return request_id, decode_msg(msg_type, payload)
         return None
-    except Exception as e:
-        raise e
\ No newline at end of file
+
+    def recv(self, blocking=True):
+        """
+        Returns the next message, or None if not blocking and no message arrived
+        """
+        request = self.recv_request(blocking)
+        return request[1] if request else None
+
+
+async def async_recv_request(reader):
+    """
+    Reads one message from an asyncio StreamReader, waiting until it fully arrives
+    Returns its request id and the message
+    """
+    msg_type, request_id, payload_len = protocol.decode_header(await reader.readexactly(protocol.HEADER.size))
+    return request_id, decode_msg(msg_type, await reader.readexactly(payload_len))
+
+def write_msg(writer, msg, request_id=protocol.PUSH_ID):
+    """
+    Buffers one message on an asyncio StreamWriter, the caller is responsible for draining
+    """
+    writer.write(encode_msg(msg, request_id))
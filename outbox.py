@@ -0,0 +1,87 @@
+import time
+import threading
+from collections import deque
+
+
+MAX_QUEUED_REPLIES = 64  # a client that sends more requests without reading the replies is dropped
+MAX_SEND_TIME = 5  # seconds a single send may stay blocked on a slow client before it is dropped
+
+
+class SlowClientError(Exception):
+    pass
+
+
+class Outbox:
+    """
+    The messages waiting to be sent to one client, sent by the connection's sender
+    Replies are sent before pushes, and a pushed message replaces the unsent message pushed with the same key,
+    so a slow client gets the latest state of each view instead of every state in between.
+    A client that stops reading is dropped: put_reply raises SlowClientError once too many replies wait,
+    and check_client raises it once a send stays blocked for too long.
+    """
+    def __init__(self, wakeup=None, max_queued_replies=MAX_QUEUED_REPLIES, max_send_time=MAX_SEND_TIME):
+        self.wakeup = wakeup  # called whenever a message is queued
+        self.max_queued_replies = max_queued_replies
+        self.max_send_time = max_send_time
+        self.replies = deque()
+        self.pushes = {}  # key: message, oldest first
+        self.sending_since = None  # when the send in progress started
+        self.is_closed = False
+        self.lock = threading.Lock()
+
+    def put_reply(self, msg, key=None):
+        """
+        Queues a reply, it replaces the unsent message pushed with the key as the reply is newer
+        """
+        with self.lock:
+            if len(self.replies) >= self.max_queued_replies:
+                raise SlowClientError(f"{len(self.replies)} replies are waiting to be sent")
+            self.replies.append(msg)
+            if key is not None:
+                self.pushes.pop(key, None)
+        if self.wakeup:
+            self.wakeup()
+
+    def put_push(self, key, msg):
+        with self.lock:
+            self.pushes.pop(key, None)  # the new message goes to the back of the line
+            self.pushes[key] = msg
+        if self.wakeup:
+            self.wakeup()
+
+    def pop(self):
+        """
+        Returns the next message to send, or None if there is nothing to send
+        """
+        with self.lock:
+            if self.replies:
+                return self.replies.popleft()
+            if self.pushes:
+                key = next(iter(self.pushes))
+                return self.pushes.pop(key)
+        return None
+
+    def __len__(self):
+        return len(self.replies) + len(self.pushes)
+
+    def close(self):
+        """
+        Stops the connection's sender once it sent what was queued
+        """
+        self.is_closed = True
+        if self.wakeup:
+            self.wakeup()
+
+    def started_sending(self):
+        self.sending_since = time.monotonic()
+
+    def done_sending(self):
+        self.sending_since = None
+
+    def check_client(self):
+        """
+        Raises SlowClientError if the send in progress is blocked for too long
+        """
+        sending_since = self.sending_since
+        if sending_since is not None and time.monotonic() - sending_since > self.max_send_time:
+            raise SlowClientError(f"blocked sending for {time.monotonic() - sending_since:.1f} seconds")
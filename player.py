@@ -1,13 +1,12 @@
-import math
 import time
+from collections import namedtuple
 
-import copy
-
-import config
-from game_file import Game, PlantMine, Torpedo, ActivateMine, Silence, Drone, Sonar, Surface
-from common import ActionType
+from metrics import metrics
+from game_file import PlantMine, Torpedo, ActivateMine, Silence, Drone, Sonar, Surface
+from common import ActionType, PlayerRole
 
 TORPEDO_RANGE = 4
+BUILD_STATE_METRICS = {role: f"build_state_seconds.{role.name.lower()}" for role in PlayerRole}
 
 class Player:
     def __init__(self, team, role, submarine):
@@ -15,6 +14,9 @@ class Player:
         self.role = role
         self.online = True
         self.submarine = submarine
+        self.state = None
+        self.state_version = None  # the version of the player's view self.state was built at
+        self.build_state_metric = BUILD_STATE_METRICS[role]
 
     def disconnected(self):
         self.online = False
@@ -23,6 +25,24 @@ class Player:
         pass
 
     def get_state(self, game):
+        """
+        Returns the player's state, rebuilt only if the player's view changed since it was last built
+        """
+        view_version = game.view_versions[self.view]
+        if self.state_version != view_version:
+            start = time.perf_counter()
+            self.state = self.build_state(game)
+            self.state_version = view_version
+            metrics.observe(self.build_state_metric, time.perf_counter() - start)
+        else:
+            metrics.count("state_cache_hits")
+        return self.state
+
+    @property
+    def view(self):
+        return self.team, self.role
+
+    def build_state(self, game):
         pass
 
     def can_act(self, game):
@@ -38,79 +58,36 @@ class CaptainPlayer(Player):
                                            and game.power_in_action.is_need_to_act_captain_show_board)
 
     def get_board_string(self, game):
-        board_str = ""
+        """
+        Returns the captain's board, a char per cell: b (black) for the submarine's location, r (red) for its path,
+        g (green) for its mines, y (yellow) for where it can move or aim, w (white) for nothing
+        """
+        masks = game.masks
+        loc_mask = masks.bit(self.submarine.loc)
 
         if game.power_in_action and game.power_in_action.need_to_act_team == self.team \
                 and game.power_in_action.is_need_to_act_captain_show_board:
 
             if game.power_in_action.action_type == ActionType.TORPEDO:
-                possible_torpedo_targets = game.bfs(self.submarine.loc, TORPEDO_RANGE)
-                for i in range(config.BOARD_WIDTH):
-                    for j in range(config.BOARD_HEIGHT):
-                        if (i, j) == self.submarine.loc:
-                            board_str += "b" # submarine location is marked b for black
-                        elif (i, j) in self.submarine.mines:
-                            board_str += "g"  # submarine mines are marked g for green
-                        elif (i, j) in possible_torpedo_targets:
-                            board_str += "y"  # possible move loc marked y for yellow
-                        else:
-                            board_str += "w" # white for nothing
+                possible_torpedo_targets = masks.mask(game.distances.cells_in_range(self.submarine.loc,
+                                                                                     TORPEDO_RANGE))
+                return masks.board_string(possible_torpedo_targets, "y",
+                                          [(self.submarine.mines.mask, "g"), (loc_mask, "b")])
 
             elif game.power_in_action.action_type == ActionType.ACTIVATE_MINE:
-                for i in range(config.BOARD_WIDTH):
-                    for j in range(config.BOARD_HEIGHT):
-                        if (i, j) == self.submarine.loc:
-                            board_str += "b" # submarine location is marked b for black
-                        elif (i, j) in self.submarine.mines:
-                            board_str += "y"  # possible move loc marked y for yellow
-                        else:
-                            board_str += "w" # white for nothing
+                return masks.board_string(self.submarine.mines.mask, "y", [(loc_mask, "b")])
 
             elif game.power_in_action.action_type == ActionType.SILENCE:
-                possible_silence_cords = self.submarine.get_possible_silence_cords(game)
-                for i in range(config.BOARD_WIDTH):
-                    for j in range(config.BOARD_HEIGHT):
-                        if (i, j) == self.submarine.loc:
-                            board_str += "b" # submarine location is marked b for black
-                        elif (i, j) in possible_silence_cords:
-                            board_str += "y"  # possible move loc marked y for yellow
-                        else:
-                            board_str += "w" # white for nothing
+                return masks.board_string(self.submarine.get_possible_silence_mask(), "y", [(loc_mask, "b")])
 
             elif game.power_in_action.action_type == ActionType.DRONE:
-                for i in range(config.BOARD_WIDTH):
-                    for j in range(config.BOARD_HEIGHT):
-                        if (i, j) == self.submarine.loc:
-                            board_str += "b" # submarine location is marked b for black
-                        elif (i-2)%5 == 0 and (j-2)%5 == 0:
-                            board_str += "y"  # possible move loc marked y for yellow
-                        else:
-                            board_str += "w" # white for nothing
-
-        if board_str == "":
-            if not self.submarine.loc:
-                for i in range(config.BOARD_WIDTH):
-                    for j in range(config.BOARD_HEIGHT):
-                        if self.can_act(game) and not game.board[i][j].is_island:
-                            board_str += "y"  # possible move loc marked y for yellow
-                        else:
-                            board_str += "w" # white for nothing
-            else:
-                for i in range(config.BOARD_WIDTH):
-                    for j in range(config.BOARD_HEIGHT):
-                        if (i, j) == self.submarine.loc:
-                            board_str += "b" # submarine location is marked b for black
-                        elif (i, j) in self.submarine.path:
-                            board_str += "r"  # submarine past locations are marked r for red
-                        elif (i, j) in self.submarine.mines:
-                            board_str += "g"  # submarine mines are marked g for green
-                        elif self.can_act(game) and Game.in_map((i, j)) and not game.board[i][j].is_island \
-                                and (i, j) not in self.submarine.path \
-                                and math.hypot(i - self.submarine.loc[0], j - self.submarine.loc[1]) == 1:
-                            board_str += "y"  # possible move loc marked y for yellow
-                        else:
-                            board_str += "w" # white for nothing
-        return board_str
+                return masks.board_string(masks.drone_targets, "y", [(loc_mask, "b")])
+
+        can_act = self.can_act(game)
+        if not self.submarine.loc:
+            return masks.board_string(masks.water if can_act else 0)
+        return masks.board_string(self.submarine.free_neighbors_mask() if can_act else 0, "y",
+                                  [(self.submarine.mines.mask, "g"), (self.submarine.path.mask, "r"), (loc_mask, "b")])
 
     def clicked(self, game, target):
         if game.power_in_action and game.power_in_action.need_to_act_team == self.team and \
@@ -120,10 +97,10 @@ class CaptainPlayer(Player):
             self.move_submarine_to(game, target)
 
     def move_submarine_to(self, game, target):
-        if Game.in_map(target) and not game.board[target[0]][target[1]].is_island and target not in self.submarine.path + self.submarine.mines:
+        if self.submarine.is_free(target):
             self.submarine.move(target)
 
-    def get_state(self, game):
+    def build_state(self, game):
         return CaptainState.from_player(self, game)
 
     def start_power(self, game, action_type_submitted):
@@ -167,7 +144,7 @@ class FirstMatePlayer(Player):
     def clicked(self, game, power_clicked_index):
         self.load_power(power_clicked_index)
 
-    def get_state(self, game):
+    def build_state(self, game):
         return FirstMateState.from_player(self, game)
 
     def load_power(self, power_clicked_index):
@@ -183,7 +160,7 @@ class EngineerPlayer(Player):
     def can_act(self, game):
         return not self.submarine.is_engineer_check
 
-    def get_state(self, game):
+    def build_state(self, game):
         return EngineerState.from_player(self, game)
 
     def get_tools_state(self, game):
@@ -199,11 +176,7 @@ class EngineerPlayer(Player):
         self.brake_tool(tool_to_brake_cords)
 
     def brake_tool(self, tool_to_brake_cords):
-        tool_to_brake = None
-        for tool in self.submarine.tools:
-            if tool.cords == tool_to_brake_cords:
-                tool_to_brake = tool
-                break
+        tool_to_brake = self.submarine.panel.tool_at(tool_to_brake_cords)
         if tool_to_brake and not tool_to_brake.is_broken \
                 and tool_to_brake.direction == self.submarine.last_move_direction.split(' ')[-1]:
             self.submarine.brake_tool(tool_to_brake)
@@ -213,16 +186,21 @@ class EngineerPlayer(Player):
 class RadioOperatorPlayer(Player):
     def __init__(self, team, role, submarine):
         super().__init__(team, role, submarine)
-        self.submarine.engineer = self
 
     def can_act(self, game):
         return True
 
-    def get_state(self, game):
+    def build_state(self, game):
         return RadioOperatorState.from_player(self, game)
 
 
 class State:
+    """
+    The state a player is sent, compared and encoded field by field in the order of fields
+    """
+    __slots__ = ("can_act", "is_game_stopped")
+    fields = __slots__
+
     def __init__(self, can_act, is_game_stopped):
         self.can_act = can_act
         self.is_game_stopped = is_game_stopped
@@ -232,25 +210,69 @@ class State:
         return cls(player.can_act(game), game.is_stopped or bool(player.submarine.surfacing))
 
     def __eq__(self, other):
-        return tuple(self) == tuple(other)
+        return self is other or tuple(self) == tuple(other)
 
     def __iter__(self):
-        yield from self.__dict__.values()
+        for field in self.fields:
+            yield getattr(self, field)
 
 
 class CaptainState(State):
-    def __init__(self, can_act, is_game_stopped, board_str, power_in_action=None):
+    __slots__ = ("board_str", "board_width", "power_in_action")
+    fields = State.fields + __slots__
+
+    def __init__(self, can_act, is_game_stopped, board_str, board_width, power_in_action=None):
         super().__init__(can_act, is_game_stopped)
-        self.board_str = board_str
+        self.board_str = board_str  # the board's cells row by row, board_width cells per row
+        self.board_width = board_width
         self.power_in_action = power_in_action
 
     @classmethod
     def from_player(cls, player, game):
         state = State.from_player(player, game)
-        return cls(state.can_act, state.is_game_stopped, player.get_board_string(game), copy.copy(game.power_in_action))
+        return cls(state.can_act, state.is_game_stopped, player.get_board_string(game), game.map.width,
+                   game.power_in_action.snapshot() if game.power_in_action else None)
+
+
+class CaptainBoardDelta:
+    """
+    A captain state sent as only the board cells that changed since the previous captain state
+    """
+    __slots__ = ("can_act", "is_game_stopped", "board_changes", "power_in_action")
+
+    def __init__(self, can_act, is_game_stopped, board_changes, power_in_action=None):
+        self.can_act = can_act
+        self.is_game_stopped = is_game_stopped
+        self.board_changes = board_changes
+        self.power_in_action = power_in_action
+
+    @classmethod
+    def between(cls, old_state, new_state):
+        """
+        Returns the delta turning old_state into new_state,
+        or None if the boards can't be diffed or sending the full board is cheaper
+        """
+        if not isinstance(old_state, CaptainState) or len(old_state.board_str) != len(new_state.board_str):
+            return None
+        board_changes = [(i, char) for i, (old_char, char) in enumerate(zip(old_state.board_str, new_state.board_str))
+                         if old_char != char]
+        # every change costs 3 bytes on the wire while the full board costs half a byte per cell
+        if 3 * len(board_changes) >= len(new_state.board_str) // 2:
+            return None
+        return cls(new_state.can_act, new_state.is_game_stopped, board_changes, new_state.power_in_action)
+
+    def apply(self, old_state):
+        board = list(old_state.board_str)
+        for i, char in self.board_changes:
+            board[i] = char
+        return CaptainState(self.can_act, self.is_game_stopped, "".join(board), old_state.board_width,
+                            self.power_in_action)
 
 
 class FirstMateState(State):
+    __slots__ = ("powers_charges", "hp")
+    fields = State.fields + __slots__
+
     def __init__(self, can_act, is_game_stopped, powers_charges, hp):
         super().__init__(can_act, is_game_stopped)
         self.powers_charges = powers_charges
@@ -263,6 +285,9 @@ class FirstMateState(State):
 
 
 class EngineerState(State):
+    __slots__ = ("tools_state",)
+    fields = State.fields + __slots__
+
     def __init__(self, can_act, is_game_stopped, tools_state):
         super().__init__(can_act, is_game_stopped)
         self.tools_state = tools_state
@@ -274,6 +299,9 @@ class EngineerState(State):
     
 
 class RadioOperatorState(State):
+    __slots__ = ("last_enemy_move_direction",)
+    fields = State.fields + __slots__
+
     def __init__(self, can_act, is_game_stopped, last_enemy_move_direction):
         super().__init__(can_act, is_game_stopped)
         self.last_enemy_move_direction = last_enemy_move_direction
@@ -284,3 +312,7 @@ class RadioOperatorState(State):
         enemy_submarine = player.submarine.get_enemy_submarine(game)
         last_enemy_move_direction = enemy_submarine.last_move_direction
         return cls(state.can_act, state.is_game_stopped, last_enemy_move_direction)
+
+
+# the state of one view, sent to spectators who watch several views on one connection
+ViewState = namedtuple('ViewState', ['team', 'role', 'state'])
@@ -0,0 +1,361 @@
+"""
+Binary wire protocol between the clients and the server
+
+Every frame is a fixed header (protocol version, message type, request id, payload length)
+followed by the payload. Game states and the known command strings have purpose-built
+encodings, anything else is sent as a tagged value (None, bool, int, str, tuple, list).
+Nothing is unpickled, so a frame can never run code on the receiving side.
+
+Requests carry an id chosen by the client and the server's reply carries the same id,
+so several requests can be in flight. Updates the server pushes on its own carry PUSH_ID.
+"""
+import struct
+
+# developer note: player must be imported from before game_file to avoid circular importing
+from player import State, CaptainState, CaptainBoardDelta, FirstMateState, EngineerState, RadioOperatorState, ViewState
+from game_file import PowerSnapshot
+from common import PlayerRole, Team
+
+
+PROTOCOL_VERSION = 3
+
+HEADER = struct.Struct("!BBII")  # version, message type, request id, payload length
+
+PUSH_ID = 0
+MAX_REQUEST_ID = 2 ** 32 - 1
+MAX_FRAME_LEN = 1024 * 1024  # the longest payload accepted, a longer one is refused before it is buffered
+
+MSG_STRING = 1
+MSG_VALUE = 2
+MSG_COMMAND = 3
+MSG_CAPTAIN_STATE = 4
+MSG_FIRST_MATE_STATE = 5
+MSG_ENGINEER_STATE = 6
+MSG_RADIO_OPERATOR_STATE = 7
+MSG_CAPTAIN_BOARD_DELTA = 8
+MSG_VIEW_STATE = 9
+MSG_TYPE_NAMES = {MSG_STRING: "string",
+                  MSG_VALUE: "value",
+                  MSG_COMMAND: "command",
+                  MSG_CAPTAIN_STATE: "captain_state",
+                  MSG_FIRST_MATE_STATE: "first_mate_state",
+                  MSG_ENGINEER_STATE: "engineer_state",
+                  MSG_RADIO_OPERATOR_STATE: "radio_operator_state",
+                  MSG_CAPTAIN_BOARD_DELTA: "captain_board_delta",
+                  MSG_VIEW_STATE: "view_state"}
+
+# command strings sent as a single byte, their index in the list
+# a command sent together with its payload, as (command, payload), has the payload value appended
+COMMANDS = ["get",
+            "captain clicked loc",
+            "first mate clicked power",
+            "engineer clicked tool",
+            "captain stop",
+            "captain resume",
+            "captain sonar answer",
+            "captain submitted",  # followed by the action type byte
+            "role accepted",
+            "role taken",
+            "joined",
+            "no such game",
+            "spectate",  # followed by the spectated team, or None for both teams
+            "spectating"]
+COMMAND_CODES = {command: code for code, command in enumerate(COMMANDS)}
+SUBMITTED_COMMAND = "captain submitted"
+
+# captain board chars, two cells are packed in one byte
+BOARD_CHARS = "wybrg"
+BOARD_CHAR_CODES = {char: code for code, char in enumerate(BOARD_CHARS)}
+
+TAG_NONE = 0
+TAG_FALSE = 1
+TAG_TRUE = 2
+TAG_INT = 3
+TAG_STR = 4
+TAG_TUPLE = 5
+TAG_LIST = 6
+
+INT = struct.Struct("!q")
+LEN = struct.Struct("!H")
+CELL_CHANGE = struct.Struct("!HB")  # board index, board char code
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_frame(msg_type, payload, request_id=PUSH_ID):
+    return HEADER.pack(PROTOCOL_VERSION, msg_type, request_id, len(payload)) + payload
+
+
+def decode_header(header):
+    """
+    Returns the message type, request id and payload length of a frame header
+    Raises ProtocolError for another protocol version or a payload longer than MAX_FRAME_LEN
+    """
+    version, msg_type, request_id, payload_len = HEADER.unpack(header)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"unsupported protocol version {version}")
+    if payload_len > MAX_FRAME_LEN:
+        raise ProtocolError(f"payload of {payload_len} bytes is longer than {MAX_FRAME_LEN}")
+    return msg_type, request_id, payload_len
+
+
+def encode(msg, request_id=PUSH_ID):
+    """
+    Encodes a message into a full frame
+    """
+    return encode_frame(*encode_payload(msg), request_id)
+
+
+def encode_payload(msg):
+    """
+    Returns the message type and payload encoding the message
+    """
+    if isinstance(msg, CaptainBoardDelta):
+        return MSG_CAPTAIN_BOARD_DELTA, encode_captain_board_delta(msg)
+    if isinstance(msg, ViewState):
+        return MSG_VIEW_STATE, encode_view_state(msg)
+    if isinstance(msg, State):
+        msg_type, encoder = STATE_ENCODERS[type(msg)]
+        return msg_type, encoder(msg)
+    if isinstance(msg, str):
+        command_b = encode_command(msg)
+        if command_b:
+            return MSG_COMMAND, command_b
+        return MSG_STRING, msg.encode('utf-8')
+    if isinstance(msg, tuple) and len(msg) == 2 and isinstance(msg[0], str):
+        command_b = encode_command(msg[0])
+        if command_b:
+            return MSG_COMMAND, command_b + encode_value(msg[1])
+    return MSG_VALUE, encode_value(msg)
+
+
+def encode_command(command):
+    """
+    Returns the encoding of a known command string, or None if the string is not a known command
+    """
+    if command in COMMAND_CODES:
+        return bytes((COMMAND_CODES[command],))
+    if command.startswith(SUBMITTED_COMMAND):
+        return bytes((COMMAND_CODES[SUBMITTED_COMMAND], int(command.split(' ')[-1])))
+    return None
+
+
+def decode(msg_type, payload):
+    """
+    Decodes the payload of a frame into the message it was encoded from
+    """
+    if msg_type == MSG_COMMAND:
+        command = COMMANDS[payload[0]]
+        offset = 1
+        if command == SUBMITTED_COMMAND:
+            command = f"{command} {payload[1]}"
+            offset = 2
+        if len(payload) > offset:
+            return command, decode_value(payload, offset)[0]
+        return command
+    if msg_type == MSG_STRING:
+        return bytes(payload).decode('utf-8')
+    if msg_type == MSG_VALUE:
+        return decode_value(payload, 0)[0]
+    if msg_type == MSG_CAPTAIN_BOARD_DELTA:
+        return decode_captain_board_delta(payload)
+    if msg_type == MSG_VIEW_STATE:
+        return decode_view_state(payload)
+    if msg_type in STATE_DECODERS:
+        return STATE_DECODERS[msg_type](payload)
+    raise ProtocolError(f"unknown message type {msg_type}")
+
+
+def encode_value(value):
+    if value is None:
+        return bytes((TAG_NONE,))
+    if isinstance(value, bool):
+        return bytes((TAG_TRUE if value else TAG_FALSE,))
+    if isinstance(value, int):
+        return bytes((TAG_INT,)) + INT.pack(value)
+    if isinstance(value, str):
+        return bytes((TAG_STR,)) + encode_str(value)
+    if isinstance(value, (tuple, list)):
+        tag = TAG_TUPLE if isinstance(value, tuple) else TAG_LIST
+        return bytes((tag,)) + LEN.pack(len(value)) + b"".join(encode_value(item) for item in value)
+    raise ProtocolError(f"can't encode {type(value).__name__}")
+
+
+def decode_value(payload, offset):
+    """
+    Returns the value encoded at the offset and the offset after it
+    """
+    tag = payload[offset]
+    offset += 1
+    if tag == TAG_NONE:
+        return None, offset
+    if tag == TAG_FALSE:
+        return False, offset
+    if tag == TAG_TRUE:
+        return True, offset
+    if tag == TAG_INT:
+        return INT.unpack_from(payload, offset)[0], offset + INT.size
+    if tag == TAG_STR:
+        return decode_str(payload, offset)
+    if tag in (TAG_TUPLE, TAG_LIST):
+        count = LEN.unpack_from(payload, offset)[0]
+        offset += LEN.size
+        items = []
+        for _ in range(count):
+            item, offset = decode_value(payload, offset)
+            items.append(item)
+        return (tuple(items) if tag == TAG_TUPLE else items), offset
+    raise ProtocolError(f"unknown value tag {tag}")
+
+
+def encode_str(value):
+    value_b = value.encode('utf-8')
+    return LEN.pack(len(value_b)) + value_b
+
+
+def decode_str(payload, offset):
+    str_len = LEN.unpack_from(payload, offset)[0]
+    offset += LEN.size
+    return bytes(payload[offset:offset + str_len]).decode('utf-8'), offset + str_len
+
+
+def encode_flags(*flags):
+    return bytes((sum(1 << i for i, flag in enumerate(flags) if flag),))
+
+
+def decode_flags(flags_byte, count):
+    return [bool(flags_byte & (1 << i)) for i in range(count)]
+
+
+def encode_board(board_str):
+    codes = [BOARD_CHAR_CODES[char] for char in board_str]
+    if len(codes) % 2:
+        codes.append(0)
+    return LEN.pack(len(board_str)) + bytes(codes[i] << 4 | codes[i + 1] for i in range(0, len(codes), 2))
+
+
+def decode_board(payload, offset):
+    board_len = LEN.unpack_from(payload, offset)[0]
+    offset += LEN.size
+    packed_len = (board_len + 1) // 2
+    chars = []
+    for packed in payload[offset:offset + packed_len]:
+        chars.append(BOARD_CHARS[packed >> 4])
+        chars.append(BOARD_CHARS[packed & 0xF])
+    return "".join(chars[:board_len]), offset + packed_len
+
+
+def encode_power(power):
+    return (struct.pack("!bBB", power.action_type, power.activated_team, power.need_to_act_team)
+            + encode_flags(power.is_need_to_act_captain_show_stop_menu, power.is_need_to_act_captain_show_board,
+                           power.is_need_to_act_captain_can_resume)
+            + encode_str(power.activated_captain_msg)
+            + encode_str(power.other_captain_msg))
+
+
+def decode_power(payload, offset):
+    action_type, activated_team, need_to_act_team = struct.unpack_from("!bBB", payload, offset)
+    flags = decode_flags(payload[offset + 3], 3)
+    activated_captain_msg, offset = decode_str(payload, offset + 4)
+    other_captain_msg, offset = decode_str(payload, offset)
+    return PowerSnapshot(action_type, activated_team, need_to_act_team, *flags,
+                         activated_captain_msg, other_captain_msg), offset
+
+
+def encode_captain_state(state):
+    payload = (encode_flags(state.can_act, state.is_game_stopped, state.power_in_action)
+               + LEN.pack(state.board_width)
+               + encode_board(state.board_str))
+    if state.power_in_action:
+        payload += encode_power(state.power_in_action)
+    return payload
+
+
+def decode_captain_state(payload):
+    can_act, is_game_stopped, has_power = decode_flags(payload[0], 3)
+    board_width = LEN.unpack_from(payload, 1)[0]
+    board_str, offset = decode_board(payload, 1 + LEN.size)
+    power_in_action = decode_power(payload, offset)[0] if has_power else None
+    return CaptainState(can_act, is_game_stopped, board_str, board_width, power_in_action)
+
+
+def encode_captain_board_delta(delta):
+    payload = (encode_flags(delta.can_act, delta.is_game_stopped, delta.power_in_action)
+               + LEN.pack(len(delta.board_changes))
+               + b"".join(CELL_CHANGE.pack(i, BOARD_CHAR_CODES[char]) for i, char in delta.board_changes))
+    if delta.power_in_action:
+        payload += encode_power(delta.power_in_action)
+    return payload
+
+
+def decode_captain_board_delta(payload):
+    can_act, is_game_stopped, has_power = decode_flags(payload[0], 3)
+    count = LEN.unpack_from(payload, 1)[0]
+    offset = 1 + LEN.size
+    board_changes = []
+    for i, char_code in CELL_CHANGE.iter_unpack(payload[offset:offset + count * CELL_CHANGE.size]):
+        board_changes.append((i, BOARD_CHARS[char_code]))
+    offset += count * CELL_CHANGE.size
+    power_in_action = decode_power(payload, offset)[0] if has_power else None
+    return CaptainBoardDelta(can_act, is_game_stopped, board_changes, power_in_action)
+
+
+def encode_first_mate_state(state):
+    return (encode_flags(state.can_act, state.is_game_stopped)
+            + bytes((state.hp, len(state.powers_charges)))
+            + bytes(value for power_charge in state.powers_charges for value in power_charge))
+
+
+def decode_first_mate_state(payload):
+    can_act, is_game_stopped = decode_flags(payload[0], 2)
+    hp, count = payload[1], payload[2]
+    powers_charges = [(payload[3 + 2 * i], payload[4 + 2 * i]) for i in range(count)]
+    return FirstMateState(can_act, is_game_stopped, powers_charges, hp)
+
+
+def encode_engineer_state(state):
+    return (encode_flags(state.can_act, state.is_game_stopped)
+            + bytes((len(state.tools_state),))
+            + bytes(value for (row, col), status in state.tools_state for value in (row, col, ord(status))))
+
+
+def decode_engineer_state(payload):
+    can_act, is_game_stopped = decode_flags(payload[0], 2)
+    tools_state = [((payload[2 + 3 * i], payload[3 + 3 * i]), chr(payload[4 + 3 * i])) for i in range(payload[1])]
+    return EngineerState(can_act, is_game_stopped, tools_state)
+
+
+def encode_radio_operator_state(state):
+    return encode_flags(state.can_act, state.is_game_stopped) + encode_str(state.last_enemy_move_direction)
+
+
+def decode_radio_operator_state(payload):
+    can_act, is_game_stopped = decode_flags(payload[0], 2)
+    return RadioOperatorState(can_act, is_game_stopped, decode_str(payload, 1)[0])
+
+
+def encode_view_state(view_state):
+    state_type, state_payload = encode_payload(view_state.state)
+    return bytes((view_state.team, view_state.role, state_type)) + state_payload
+
+
+def decode_view_state(payload):
+    team, role, state_type = payload[0], payload[1], payload[2]
+    return ViewState(Team(team), PlayerRole(role), decode(state_type, payload[3:]))
+
+
+STATE_ENCODERS = {
+    CaptainState: (MSG_CAPTAIN_STATE, encode_captain_state),
+    FirstMateState: (MSG_FIRST_MATE_STATE, encode_first_mate_state),
+    EngineerState: (MSG_ENGINEER_STATE, encode_engineer_state),
+    RadioOperatorState: (MSG_RADIO_OPERATOR_STATE, encode_radio_operator_state),
+}
+
+STATE_DECODERS = {
+    MSG_CAPTAIN_STATE: decode_captain_state,
+    MSG_FIRST_MATE_STATE: decode_first_mate_state,
+    MSG_ENGINEER_STATE: decode_engineer_state,
+    MSG_RADIO_OPERATOR_STATE: decode_radio_operator_state,
+}
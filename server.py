@@ -2,143 +2,533 @@ import os
 import sys
 import time
 import socket
+import select
+import asyncio
+import logging
+import threading
+from collections import namedtuple
 from _thread import start_new_thread
 
 # developer note: player must be imported from before game_file to avoid circular importing
-from player import CaptainState, FirstMateState
+from player import State, CaptainState, CaptainBoardDelta
 from game_file import Game, Power
-from network import send_msg, recv
-from common import ActionType, SURFACE_DURATION
+from lobby import Lobby
+from broadcast import spectated_views
+from timers import IdleTimer
+from outbox import Outbox, SlowClientError
+from network import FrameReader, send_msg, async_recv_request, write_msg, encode_msg, count_frame_out
+from metrics import metrics, start_stats_server, start_dump
+from logs import setup_logging
+from common import ActionType
+import protocol
 
 
 server = "127.0.0.1"
 port = 7777
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
-try:
-    s.bind((server, port))
-except socket.error as e:
-    str(e)
+IDLE_KICK_TIMEOUT = 15 * 60  # seconds a client may stay in the lobby without a request before it is disconnected
+SPECTATOR_POLL_INTERVAL = 0.1  # seconds between checks that a spectator is still connected
+CLIENT_CHECK_INTERVAL = 1  # seconds a player's thread may wait for a request or a change before checking its sends
+WRITE_BUFFER_HIGH_WATER_MARK = 16 * 1024  # bytes buffered for an asyncio client before its sender waits
 
-s.listen(2)
-print("Waiting for a connection, Server Started")
+lobby = Lobby()
+metrics.gauge("games", lambda: len(lobby.games))
 
-game = Game()
+log = logging.getLogger("server")
 
+# a message in a client's outbox, since is the perf_counter time its latency is measured from
+OutgoingMessage = namedtuple('OutgoingMessage', ['request_id', 'msg', 'is_full_state', 'since'])
 
 
-def threaded_client(conn, this_player_id):
+def handle_join_request(lobby, game_id, data):
     """
-    This function serves and handles one client
+    Handles one message sent before the client plays:
+    either a lobby command, a request to spectate, or the player's team & role for the chosen game
+    (the default game if none was chosen)
+    Returns the reply for the client, the chosen game id, the new player (None until a role is accepted)
+    and the spectated views (None unless spectating)
+    """
+    if isinstance(data, str) and data.startswith("lobby"):
+        reply, new_game_id = lobby.handle_lobby_command(data)
+        return reply, new_game_id or game_id, None, None
+
+    if isinstance(data, tuple) and data[0] == "spectate":
+        game_id = game_id or lobby.get_default_game_id(create=False)
+        if not lobby.get_actor(game_id):
+            return "no such game", game_id, None, None
+        return "spectating", game_id, None, spectated_views(data[1])
+
+    this_player_team, this_player_role = data
+    if not Game.is_valid_role(this_player_team, this_player_role):
+        return "no such role", game_id, None, None
+    if not game_id:
+        game_id = lobby.get_default_game_id()
+    this_player = lobby.join(game_id, this_player_team, this_player_role)
+    return "role accepted" if this_player else "role taken", game_id, this_player, None
+
+
+def split_command(data):
+    """
+    Returns the command and payload of a request, commands with a payload are sent as (command, payload)
+    """
+    if isinstance(data, tuple):
+        return data
+    return data, None
+
+
+def handle_command(game, this_player, data, payload=None):
+    """
+    Applies one client command to the game
+    """
+    if "clicked" in data: # user acted and the payload is what he clicked on
+        # clicks are pipelined by the client, a click sent before the player's turn came back is ignored
+        if this_player.can_act(game):
+            this_player.clicked(game, payload)
+
+    # captain stuff
+    elif data == "captain stop":
+        if not game.power_in_action:
+            game.power_in_action = Power(this_player)
+            game.is_stopped = True  # pauses the game's timers
+
+    elif data == "captain resume":
+        if game.power_in_action:
+            game.power_in_action.resume(game)
+
+    elif data == "captain sonar answer":
+        if game.power_in_action and game.power_in_action.action_type == ActionType.SONAR:
+            game.power_in_action.answer_accepted(game, payload)
+
+    elif "captain submitted" in data:
+        action_type_submitted = int(data.split(' ')[-1])
+        this_player.start_power(game, action_type_submitted)
+
+
+def state_message(last_sent_state, new_player_state):
+    """
+    Returns the message updating the client to the new state:
+    only the changed captain board cells when the client holds the last sent state,
+    the full state otherwise (the client resyncs with "get", which always gets the full state)
+    """
+    if isinstance(new_player_state, CaptainState):
+        return CaptainBoardDelta.between(last_sent_state, new_player_state) or new_player_state
+    return new_player_state
+
+
+def run_command(game, this_player, command, payload=None):
+    """
+    Applies one client command and returns the player's new state
+    Runs on the game's actor
     """
-    global game
+    start = time.perf_counter()
+    handle_command(game, this_player, command, payload)
+    metrics.observe("command_seconds", time.perf_counter() - start)
+    return this_player.get_state(game)
+
+
+def outgoing_frame(last_sent_state, msg):
+    """
+    Returns the frame of a message taken from a client's outbox, and the last state sent to the client after it
+    Frames encoded by the game's broadcast are sent as is
+    """
+    if isinstance(msg.msg, bytes):
+        count_frame_out(msg.msg)
+        return msg.msg, last_sent_state
+    if isinstance(msg.msg, State):
+        new_msg = state_message(None if msg.is_full_state else last_sent_state, msg.msg)
+        return encode_msg(new_msg, msg.request_id), msg.msg
+    return encode_msg(msg.msg, msg.request_id), last_sent_state
+
+
+def message_sent(msg):
+    """
+    Observes the latency of a message once it was handed to the socket:
+    a reply's since its request arrived, a push's since the change it carries was made
+    """
+    if msg.since is not None:
+        metrics.observe("push_latency_seconds" if msg.request_id == protocol.PUSH_ID else "reply_latency_seconds",
+                        time.perf_counter() - msg.since)
+
+
+def send_outbox(conn, outbox, outbox_ready):
+    """
+    Sends the client's outbox until it is closed, runs on its own thread so a slow client only blocks this thread
+    """
+    last_sent_state = None
+    try:
+        while not outbox.is_closed:
+            outbox_ready.wait()
+            outbox_ready.clear()
+            msg = outbox.pop()
+            while msg:
+                frame, last_sent_state = outgoing_frame(last_sent_state, msg)
+                outbox.started_sending()
+                conn.sendall(frame)
+                outbox.done_sending()
+                message_sent(msg)
+                msg = outbox.pop()
+    except OSError:
+        pass
+    except Exception as e:  # a message that can't be encoded, the client can't be kept in sync anymore
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+        log.warning("%s %s %s %s", exc_type, fname, exc_tb.tb_lineno, e)
+        try:
+            conn.shutdown(socket.SHUT_RDWR)  # the client's thread sees the connection closed and cleans up
+        except OSError:
+            pass
+
+
+def spectate(reader, outbox, actor, views):
+    """
+    Sends the changes of the spectated views to the client until it disconnects
+    Requests from spectators are ignored
+    """
+    def send(view, frame):
+        outbox.put_push(view, OutgoingMessage(protocol.PUSH_ID, frame, False, actor.game.changed_at))
+
+    actor.call(actor.broadcast.add, views, send)
+    try:
+        while True:
+            time.sleep(SPECTATOR_POLL_INTERVAL)
+            outbox.check_client()
+            while reader.recv_request(blocking=False):  # raises once the client disconnected
+                pass
+    finally:
+        actor.call(actor.broadcast.remove, views, send)
 
-    # recieves player request to join game
+
+def threaded_client(conn):
+    """
+    This function serves and handles one client
+    """
+    # recieves lobby commands and player request to join game
+    reader = FrameReader(conn)
+    idle_timer = IdleTimer(IDLE_KICK_TIMEOUT, lambda: conn.shutdown(socket.SHUT_RDWR))
     this_player = None
-    while True:
-        # recieves player team & role
+    views = None
+    game_id = None
+    while not this_player and not views:
+        # recieves lobby command or player team & role
         try:
-            this_player_team, this_player_role = recv(conn)
+            request_id, data = reader.recv_request()
+            idle_timer.touch()
+            reply, game_id, this_player, views = handle_join_request(lobby, game_id, data)
+            send_msg(conn, reply, request_id)
         except Exception as e:
             exc_type, exc_obj, exc_tb = sys.exc_info()
             fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-            print(exc_type, fname, exc_tb.tb_lineno, str(e))
+            log.warning("%s %s %s %s", exc_type, fname, exc_tb.tb_lineno, e)
             break
 
-        # checks if role is not taken
-        for player in game.players:
-            if player.online and player.role == this_player_role and player.team == this_player_team:
-                send_msg(conn, "role taken")
-                break
+    # the states are sent from their own thread
+    outbox_ready = threading.Event()
+    outbox = Outbox(outbox_ready.set)
+    if this_player or views:
+        start_new_thread(send_outbox, (conn, outbox, outbox_ready))
 
-        # if role is accepted
-        else:
-            send_msg(conn, "role accepted")
-            this_player = game.add_new_player(this_player_team, this_player_role)
-            break
+    # players in a game may wait long without a request: the radio operator only listens, a stop can last
+    idle_timer.cancel()
+    if views:
+        try:
+            spectate(reader, outbox, lobby.get_actor(game_id), views)
+        except SlowClientError as e:
+            log.warning("Dropping slow client: %s", e)
+            metrics.count("slow_clients_dropped")
+        except Exception as e:
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+            log.warning("%s %s %s %s", exc_type, fname, exc_tb.tb_lineno, e)
 
     # receives and handles requests and notifications from user
-    current_player_state = this_player.get_state(game)
+    actor = lobby.get_actor(game_id)
+    game = actor.game if actor else None
+    current_player_state = None  # the last state queued for the client
+    view_changed = threading.Event()
+    # the thread waits on the client's socket, a change of the view wakes it by writing to this pair
+    wake_receiver, wake_sender = socket.socketpair()
+    wake_sender.setblocking(False)
+
+    def notify_view_changed():
+        view_changed.set()
+        try:
+            wake_sender.send(b"\0")
+        except OSError:
+            pass  # a wakeup is already pending
+    if this_player:
+        actor.call(game.subscribe, this_player.view, notify_view_changed)
     while this_player:
         try:
-            if this_player.submarine.surfacing and not game.is_stopped:
-                if time.time() > this_player.submarine.surfacing + this_player.submarine.surface_duration:
-                    this_player.submarine.surfacing = False
-                    this_player.submarine.surface_duration = SURFACE_DURATION
-
-            data = recv(conn, blocking=False)
-
-            if data:
-
-                if data == "get": # client init
-                    current_player_state = this_player.get_state(game)
-
-                elif "clicked" in data: # user acted and the client will send what he clicked on
-                    target_clicked = recv(conn)
-                    this_player.clicked(game, target_clicked)
-                    current_player_state = this_player.get_state(game)
-
-                # captain stuff
-                elif data == "captain stop":
-                    if not game.power_in_action:
-                        game.power_in_action = Power(this_player)
-                        game.is_stopped = True
-                        for submarine in game.submarines:
-                            if submarine.surfacing:
-                                submarine.surface_duration = submarine.surface_duration - (time.time() - submarine.surfacing)
-                    current_player_state = this_player.get_state(game)
-
-                elif data == "captain resume":
-                    if game.power_in_action:
-                        game.power_in_action.resume(game)
-                    current_player_state = this_player.get_state(game)
-
-                elif data == "captain sonar answer":
-                    answer_data = recv(conn)
-                    if game.power_in_action and game.power_in_action.action_type == ActionType.SONAR:
-                        game.power_in_action.answer_accepted(game, answer_data)
-                    current_player_state = this_player.get_state(game)
-
-                elif "captain submitted" in data:
-                    action_type_submitted = int(data.split(' ')[-1])
-                    this_player.start_power(game, action_type_submitted)
-
-                    current_player_state = this_player.get_state(game)
-
-                send_msg(conn, tuple(current_player_state))
-
-            # update client for the new state if needed
-            if this_player.get_state(game) != current_player_state:
-                send_msg(conn, "sending game state")
-                current_player_state = this_player.get_state(game)
-                send_msg(conn, tuple(current_player_state))
-
+            outbox.check_client()
+            request = reader.recv_request(blocking=False)
+
+            if request:
+                received_at = time.perf_counter()
+                request_id, data = request
+                command, payload = split_command(data)
+                new_player_state = actor.call(run_command, game, this_player, command, payload)
+                outbox.put_reply(OutgoingMessage(request_id, new_player_state, command == "get", received_at),
+                                 this_player.view)
+                current_player_state = new_player_state
+
+            # push the new state to the client if its view changed
+            if current_player_state and view_changed.is_set():
+                view_changed.clear()
+                new_player_state = actor.call(this_player.get_state, game)
+                if new_player_state != current_player_state:
+                    outbox.put_push(this_player.view,
+                                    OutgoingMessage(protocol.PUSH_ID, new_player_state, False, game.changed_at))
+                    current_player_state = new_player_state
+
+            # nothing to do until the client sends a request or the view changes
+            if not request and not (current_player_state and view_changed.is_set()):
+                readable, _, _ = select.select([conn, wake_receiver], [], [], CLIENT_CHECK_INTERVAL)
+                if wake_receiver in readable:
+                    wake_receiver.recv(4096)
+
+        except SlowClientError as e:
+            log.warning("Dropping slow client: %s", e)
+            metrics.count("slow_clients_dropped")
+            break
         except Exception as e:
             exc_type, exc_obj, exc_tb = sys.exc_info()
             fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-            print(exc_type, fname, exc_tb.tb_lineno, str(e))
+            log.warning("%s %s %s %s", exc_type, fname, exc_tb.tb_lineno, e)
             break
 
-    print("Lost connection")
+    log.info("Lost connection")
+    metrics.count("connections", -1)
+    outbox.close()
     conn.close()
-    this_player.disconnected()
+    if this_player:
+        actor.call(game.unsubscribe, this_player.view, notify_view_changed)
+        lobby.leave(game_id, this_player)
+    wake_receiver.close()
+    wake_sender.close()
+
+
+class AsyncConnection:
+    """
+    One client served by the asyncio server
+    The client's state is pushed only when its game publishes a change to the player's view
+    Game changes run on the game's actor, the event loop only waits for their results
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.game_id = None
+        self.actor = None
+        self.player = None
+        self.views = None  # the spectated views, if spectating
+        self.current_player_state = None  # the last state queued for the client
+        self.view_changed = asyncio.Event()
+        self.outbox_ready = asyncio.Event()
+        self.outbox = Outbox(self.outbox_ready.set)
+        self.loop = None
+        self.idle_timer = None
+
+    def notify_view_changed(self):
+        """
+        Called by the game's actor thread when the player's view changed
+        """
+        self.loop.call_soon_threadsafe(self.view_changed.set)
+
+    async def serve(self):
+        """
+        Serves the client until it disconnects
+        """
+        peer = self.writer.get_extra_info('peername')
+        log.info("Connected to: %s", peer)
+        metrics.count("connections")
+        self.loop = asyncio.get_running_loop()
+        self.idle_timer = IdleTimer(IDLE_KICK_TIMEOUT,
+                                    lambda: self.loop.call_soon_threadsafe(self.writer.transport.abort))
+        try:
+            await self.join()
+            # players in a game may wait long without a request: the radio operator only listens, a stop can last
+            self.idle_timer.cancel()
+            self.writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH_WATER_MARK)
+            sender = asyncio.create_task(self.send_outbox())
+            try:
+                if self.views:
+                    await self.spectate()
+                else:
+                    await self.run_on_actor(self.actor.game.subscribe, self.player.view, self.notify_view_changed)
+                    pusher = asyncio.create_task(self.push_updates())
+                    try:
+                        await self.handle_commands()
+                    finally:
+                        pusher.cancel()
+            finally:
+                sender.cancel()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except SlowClientError as e:
+            log.warning("Dropping slow client %s: %s", peer, e)
+            metrics.count("slow_clients_dropped")
+        except Exception as e:
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+            log.warning("%s %s %s %s", exc_type, fname, exc_tb.tb_lineno, e)
+
+        log.info("Lost connection")
+        metrics.count("connections", -1)
+        self.idle_timer.cancel()
+        self.writer.close()
+        if self.player:
+            await asyncio.to_thread(self.leave)
+
+    def leave(self):
+        self.actor.call(self.actor.game.unsubscribe, self.player.view, self.notify_view_changed)
+        lobby.leave(self.game_id, self.player)
+
+    async def join(self):
+        while not self.player and not self.views:
+            request_id, data = await async_recv_request(self.reader)
+            self.idle_timer.touch()
+            reply, self.game_id, self.player, self.views = await asyncio.to_thread(handle_join_request, lobby,
+                                                                                   self.game_id, data)
+            write_msg(self.writer, reply, request_id)
+            await self.writer.drain()
+        self.actor = lobby.get_actor(self.game_id)
+
+    async def spectate(self):
+        """
+        Sends the changes of the spectated views until the client disconnects, requests from spectators are ignored
+        The frames are encoded once by the game's broadcast and shared by all of its spectators
+        """
+        await self.run_on_actor(self.actor.broadcast.add, self.views, self.push_spectated_frame)
+        try:
+            while True:
+                await async_recv_request(self.reader)
+        finally:
+            await self.run_on_actor(self.actor.broadcast.remove, self.views, self.push_spectated_frame)
+
+    def push_spectated_frame(self, view, frame):
+        """
+        Called by the game's actor thread with a new frame of a spectated view
+        """
+        self.loop.call_soon_threadsafe(self.outbox.put_push, view,
+                                       OutgoingMessage(protocol.PUSH_ID, frame, False, self.actor.game.changed_at))
+
+    async def send_outbox(self):
+        """
+        Writes the outbox to the client, a client that doesn't read for too long is dropped
+        Messages queued while waiting for the client to read replace the older states of their views
+        """
+        last_sent_state = None
+        while True:
+            await self.outbox_ready.wait()
+            self.outbox_ready.clear()
+            msg = self.outbox.pop()
+            while msg:
+                try:
+                    frame, last_sent_state = outgoing_frame(last_sent_state, msg)
+                except Exception as e:  # a message that can't be encoded, the client can't be kept in sync anymore
+                    exc_type, exc_obj, exc_tb = sys.exc_info()
+                    fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+                    log.warning("%s %s %s %s", exc_type, fname, exc_tb.tb_lineno, e)
+                    self.writer.transport.abort()
+                    return
+                self.writer.write(frame)
+                message_sent(msg)
+                msg = self.outbox.pop()
+            try:
+                await asyncio.wait_for(self.writer.drain(), self.outbox.max_send_time)
+            except asyncio.TimeoutError:
+                log.warning("Dropping slow client %s", self.writer.get_extra_info('peername'))
+                metrics.count("slow_clients_dropped")
+                self.writer.transport.abort()
+                return
+
+    async def run_on_actor(self, func, *args):
+        return await asyncio.wrap_future(self.actor.submit(func, *args))
+
+    async def handle_commands(self):
+        while True:
+            request_id, data = await async_recv_request(self.reader)
+            received_at = time.perf_counter()
+            command, payload = split_command(data)
+            new_player_state = await self.run_on_actor(run_command, self.actor.game, self.player, command, payload)
+            self.outbox.put_reply(OutgoingMessage(request_id, new_player_state, command == "get", received_at),
+                                  self.player.view)
+            self.current_player_state = new_player_state
+
+    async def push_updates(self):
+        while True:
+            await self.view_changed.wait()
+            self.view_changed.clear()
+            if not self.current_player_state:
+                continue
+            new_player_state = await self.run_on_actor(self.player.get_state, self.actor.game)
+            if new_player_state != self.current_player_state:
+                self.outbox.put_push(self.player.view, OutgoingMessage(protocol.PUSH_ID, new_player_state, False,
+                                                                       self.actor.game.changed_at))
+                self.current_player_state = new_player_state
+
+
+async def async_client(reader, writer):
+    await AsyncConnection(reader, writer).serve()
+
+
+async def async_main():
+    """
+    Serves all clients from a single asyncio event loop
+    Idle clients cost nothing until they send a command or the game changes
+    """
+    async_server = await asyncio.start_server(async_client, server, port)
+    log.info("Waiting for a connection, Async Server Started")
+    async with async_server:
+        await async_server.serve_forever()
+
 
 def main():
-    currentPlayer = 0
-    addreses_dict = {}
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    try:
+        s.bind((server, port))
+    except socket.error as e:
+        str(e)
+
+    s.listen(128)
+    log.info("Waiting for a connection, Server Started")
+
     while True:
         conn, addr = s.accept()
-        print("Connected to:", addr)
-        if currentPlayer < 8:
-            start_new_thread(threaded_client, (conn, currentPlayer))
-            addreses_dict[addr[0]] = currentPlayer
-            currentPlayer += 1
-        elif addr[0] in addreses_dict:
-            start_new_thread(threaded_client, (conn, addreses_dict[addr[0]]))
+        log.info("Connected to: %s", addr)
+        metrics.count("connections")
+        start_new_thread(threaded_client, (conn,))
+
+
 
 
 
+def arg_value(name, default=None):
+    """
+    Returns the value given to a command line option, or default if the option wasn't given
+    """
+    if name in sys.argv:
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+
+def start_instrumentation():
+    """
+    Sets up logging and the metrics outputs from the command line options:
+    --log-level LEVEL (DEBUG logs every sampled message), --stats-port PORT, --stats-file PATH
+    """
+    setup_logging(arg_value("--log-level", "INFO"))
+    if arg_value("--stats-port"):
+        start_stats_server(int(arg_value("--stats-port")))
+        log.info("Serving stats on http://127.0.0.1:%s/stats", arg_value("--stats-port"))
+    if arg_value("--stats-file"):
+        start_dump(arg_value("--stats-file"))
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    start_instrumentation()
+    if "--asyncio" in sys.argv:
+        asyncio.run(async_main())
+    else:
+        main()
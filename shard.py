@@ -0,0 +1,279 @@
+"""
+Process sharded server, fills all the CPU cores with games
+
+A front door process accepts the connections and answers the lobby until the client picks a game,
+then hands the connection (its file descriptor, over a unix socket) to the worker process hosting that game.
+Every worker runs the asyncio server with its own lobby, new games go to the least loaded worker,
+and game ids are prefixed with the worker's index so the front door knows where to send "lobby join".
+The workers report their games and connections to the front door every LOAD_REPORT_INTERVAL seconds.
+
+    python shard.py                    # one worker per core
+    python shard.py --workers 4        # 4 workers
+    python shard.py --round-robin      # new games go to the workers in turn instead of the least loaded
+"""
+import os
+import sys
+import signal
+import socket
+import asyncio
+import logging
+import threading
+import multiprocessing
+from multiprocessing.connection import wait
+from _thread import start_new_thread
+
+import server
+from lobby import Lobby
+from game_map import list_maps
+from network import FrameReader, send_msg
+from metrics import start_stats_server
+from logs import setup_logging
+import protocol
+
+
+LOAD_REPORT_INTERVAL = 1  # seconds
+MAX_HANDOFF_LEN = 64 * 1024  # the connection is handed off with the data the front door read but didn't handle
+DEFAULT_GAME_WORKER = 0  # hosts the default game, joined by clients that pick a role without picking a game
+
+log = logging.getLogger("shard")
+
+
+class WorkerProcess:
+    """
+    Runs inside a worker process: serves the connections handed to it by the front door
+    """
+    def __init__(self, index, channel, load_conn, log_level, stats_port=None):
+        self.index = index
+        self.channel = channel
+        self.load_conn = load_conn
+        self.log_level = log_level
+        self.stats_port = stats_port
+        self.connections = 0
+        self.loop = None
+
+    def run(self):
+        setup_logging(self.log_level)
+        if self.stats_port:
+            start_stats_server(self.stats_port)
+        server.lobby = Lobby(game_id_prefix=f"{self.index}-")
+        asyncio.run(self.main())
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.channel.setblocking(False)
+        self.loop.add_reader(self.channel.fileno(), self.accept_handoff)
+        while True:
+            self.load_conn.send((server.lobby.list_games(), self.connections))
+            await asyncio.sleep(LOAD_REPORT_INTERVAL)
+
+    def accept_handoff(self):
+        try:
+            data, fds, flags, addr = socket.recv_fds(self.channel, MAX_HANDOFF_LEN, 1)
+        except BlockingIOError:
+            return
+        if not fds:  # the front door is gone
+            self.loop.stop()
+            return
+        self.loop.create_task(self.serve(fds[0], data))
+
+    async def serve(self, fd, data):
+        """
+        Serves a handed off connection, starting with the data the front door already read from it
+        """
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        transport, stream_protocol = await self.loop.connect_accepted_socket(
+            lambda: asyncio.StreamReaderProtocol(reader), socket.socket(fileno=fd))
+        writer = asyncio.StreamWriter(transport, stream_protocol, reader, self.loop)
+        self.connections += 1
+        try:
+            await server.async_client(reader, writer)
+        finally:
+            self.connections -= 1
+
+
+def run_worker(index, channel, load_conn, log_level, stats_port, inherited_fds):
+    """
+    inherited_fds are the front door's ends of the workers' channels, which a forked worker holds copies of:
+    they are closed so the worker sees the front door going away
+    """
+    for fd in inherited_fds:
+        os.close(fd)
+    WorkerProcess(index, channel, load_conn, log_level, stats_port).run()
+
+
+class Worker:
+    """
+    The front door's handle of one worker process and its last reported load
+    """
+    def __init__(self, index, log_level="INFO", stats_port=None, other_workers=()):
+        """
+        other_workers are the workers started before this one
+        """
+        self.index = index
+        # a seqpacket socket keeps the messages apart like a datagram one, and reads EOF once the front door is gone
+        self.channel, worker_channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.load_conn, worker_load_conn = multiprocessing.Pipe(duplex=False)
+        inherited_fds = []
+        if multiprocessing.get_start_method() == "fork":  # a spawned worker inherits no file descriptors
+            inherited_fds = [fd for worker in (*other_workers, self)
+                             for fd in (worker.channel.fileno(), worker.load_conn.fileno())]
+        self.process = multiprocessing.Process(target=run_worker, args=(index, worker_channel, worker_load_conn,
+                                                                        log_level, stats_port, inherited_fds),
+                                               daemon=True)
+        self.process.start()
+        worker_channel.close()
+        worker_load_conn.close()
+        self.games = []
+        self.connections = 0
+        self.new_games = 0  # games handed off since the last load report
+
+    def load(self):
+        return len(self.games) + self.new_games, self.connections
+
+    def hand_off(self, conn, data):
+        socket.send_fds(self.channel, [data], [conn.fileno()])
+
+
+class ShardedServer:
+    """
+    The front door: accepts the connections and routes each one to the worker hosting its game
+    """
+    def __init__(self, workers_count, round_robin=False, log_level="INFO", stats_port=None):
+        """
+        Every worker serves its own stats, on stats_port + its index
+        """
+        self.workers = []
+        for index in range(workers_count):
+            self.workers.append(Worker(index, log_level, stats_port and stats_port + index, self.workers))
+        self.round_robin = round_robin
+        self.next_worker = 0
+        self.lock = threading.Lock()
+
+    def read_loads(self):
+        """
+        Keeps the workers' loads up to date, runs on its own thread
+        """
+        workers = {worker.load_conn: worker for worker in self.workers}
+        while workers:
+            for load_conn in wait(list(workers)):
+                worker = workers[load_conn]
+                try:
+                    games, connections = load_conn.recv()
+                except EOFError:
+                    log.warning("worker %s exited", worker.index)
+                    del workers[load_conn]
+                    continue
+                if (len(games), connections) != worker.load():
+                    log.info("worker %s: %s games, %s connections", worker.index, len(games), connections)
+                worker.games, worker.connections, worker.new_games = games, connections, 0
+
+    def stop_workers(self):
+        for worker in self.workers:
+            worker.process.terminate()
+        for worker in self.workers:
+            worker.process.join()
+
+    def list_games(self):
+        return [game for worker in self.workers for game in worker.games]
+
+    def workers_load(self):
+        """
+        Returns a list of (worker index, games count, connections count) of all workers
+        """
+        return [(worker.index, *worker.load()) for worker in self.workers]
+
+    def pick_worker_for_new_game(self):
+        alive_workers = [worker for worker in self.workers if worker.process.is_alive()]
+        if not alive_workers:
+            return None
+        with self.lock:
+            if self.round_robin:
+                self.next_worker += 1
+                worker = alive_workers[self.next_worker % len(alive_workers)]
+            else:
+                worker = min(alive_workers, key=Worker.load)
+            worker.new_games += 1
+        return worker
+
+    def get_worker_of_game(self, game_id):
+        index, _, _ = (game_id or "").partition('-')
+        if index.isdigit() and int(index) < len(self.workers):
+            return self.workers[int(index)]
+        return None
+
+    def route(self, data):
+        """
+        Returns the worker that should handle the message, or None and the reply to send if the front door handles it
+        """
+        if isinstance(data, str) and data.startswith("lobby"):
+            command = data.split(' ', 2)
+            if len(command) < 2:
+                return None, "unknown command"
+            if command[1] == "list":
+                return None, self.list_games()
+            elif command[1] == "workers":
+                return None, self.workers_load()
+            elif command[1] == "maps":
+                return None, list_maps()
+            elif command[1] in ("create", "create_on_map"):
+                worker = self.pick_worker_for_new_game()
+                return worker, None if worker else "no workers"
+            elif command[1] == "join":
+                worker = self.get_worker_of_game(command[2] if len(command) > 2 else None)
+                return worker, None if worker else "no such game"
+            return None, "unknown command"
+        return self.workers[DEFAULT_GAME_WORKER], None
+
+    def route_client(self, conn):
+        """
+        Answers the client's lobby commands until it picks a game, then hands it off to the game's worker
+        """
+        reader = FrameReader(conn)
+        try:
+            while True:
+                request_id, data = reader.recv_request()
+                worker, reply = self.route(data)
+                if worker:
+                    break
+                send_msg(conn, reply, request_id)
+            handoff_data = protocol.encode(data, request_id) + reader.unread()
+            if len(handoff_data) > MAX_HANDOFF_LEN:
+                raise protocol.ProtocolError("too much data to hand off")
+            worker.hand_off(conn, handoff_data)
+        except Exception as e:
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+            log.warning("%s %s %s %s", exc_type, fname, exc_tb.tb_lineno, e)
+        conn.close()  # the worker holds its own copy of the connection
+
+    def serve_forever(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((server.server, server.port))
+        s.listen(128)
+        start_new_thread(self.read_loads, ())
+        # the workers are stopped however the front door stops, a SIGTERM exits like a Ctrl+C
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        log.info("Waiting for a connection, Sharded Server Started with %s workers", len(self.workers))
+
+        try:
+            while True:
+                conn, addr = s.accept()
+                log.info("Connected to: %s", addr)
+                start_new_thread(self.route_client, (conn,))
+        finally:
+            self.stop_workers()
+
+
+def main():
+    workers_count = int(server.arg_value("--workers", os.cpu_count() or 1))
+    log_level = server.arg_value("--log-level", "INFO")
+    stats_port = server.arg_value("--stats-port")
+    setup_logging(log_level)
+    ShardedServer(workers_count, "--round-robin" in sys.argv, log_level,
+                  int(stats_port) if stats_port else None).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,56 @@
 import math
 import random
-from common import SURFACE_DURATION
+from collections import deque
+from common import SURFACE_DURATION, PlayerRole
 import game_file
 
 EXPLOSION_SIZE = 2
+# the offsets of the cells an explosion reaches, those nearer than EXPLOSION_SIZE to it
+BLAST_OFFSETS = tuple((d_row, d_col) for d_row in range(-EXPLOSION_SIZE, EXPLOSION_SIZE + 1)
+                      for d_col in range(-EXPLOSION_SIZE, EXPLOSION_SIZE + 1) if math.hypot(d_row, d_col) < EXPLOSION_SIZE)
 MAX_SILENCE_LENGTH = 4
+# the engineer's tools: (type, cords on the panel, direction, chain color or None)
+TOOLS_LAYOUT = (("weapon", (0, 0), "W", "yellow"),
+                ("special", (0, 1), "W", "yellow"),
+                ("intelligence", (1, 2), "W", "yellow"),
+                ("intelligence", (2, 0), "W", None),
+                ("radioactive", (2, 1), "W", None),
+                ("radioactive", (2, 2), "W", None),
+                ("special", (0, 3), "N", "orange"),
+                ("weapon", (1, 3), "N", "orange"),
+                ("special", (1, 5), "N", "orange"),
+                ("radioactive", (2, 3), "N", None),
+                ("weapon", (2, 4), "N", None),
+                ("radioactive", (2, 5), "N", None),
+                ("intelligence", (0, 6), "S", "silver"),
+                ("special", (1, 6), "S", "silver"),
+                ("weapon", (1, 8), "S", "silver"),
+                ("weapon", (2, 6), "S", None),
+                ("radioactive", (2, 7), "S", None),
+                ("special", (2, 8), "S", None),
+                ("intelligence", (0, 9), "E", "orange"),
+                ("special", (1, 9), "E", "silver"),
+                ("weapon", (1, 11), "E", "yellow"),
+                ("radioactive", (2, 9), "E", None),
+                ("intelligence", (2, 10), "E", None),
+                ("radioactive", (2, 11), "E", None))
+TOOL_TYPES = tuple(sorted({tool_type for tool_type, cords, direction, chain in TOOLS_LAYOUT}))
+TOOL_DIRECTIONS = tuple(sorted({direction for tool_type, cords, direction, chain in TOOLS_LAYOUT}))
+# the number of tools of every type and in every direction, the same for every submarine
+TOOL_COUNTS = {key: sum(key in (tool_type, direction) for tool_type, cords, direction, chain in TOOLS_LAYOUT)
+               for key in TOOL_TYPES + TOOL_DIRECTIONS}
+TOOL_INDICES = {cords: index for index, (tool_type, cords, direction, chain) in enumerate(TOOLS_LAYOUT)}
 
 class Submarine:
+    __slots__ = ("map", "masks", "_mines", "loc", "_path", "tools", "chains", "hp", "team", "mine_action",
+                 "torpedo_action", "drone_action", "sonar_action", "silence_action", "power_actions_list", "can_move",
+                 "is_first_mate_check", "is_engineer_check", "last_move_direction", "panel", "surfacing",
+                 "surface_duration", "silence_length", "timers", "on_change")
     direction_dict = {"N": (-1, 0), "E": (0, 1), "S": (1, 0), "W": (0, -1)}
 
-    def __init__(self, team):
+    def __init__(self, team, game_map):
+        self.map = game_map
+        self.masks = game_map.masks
         self.mines = []
         self.loc = None
         self.path = [self.loc]
@@ -28,32 +69,51 @@ class Submarine:
         self.is_engineer_check = True
         self.last_move_direction = "0 - NA"
         self.chains = {"yellow": Chain("yellow"), "orange": Chain("orange"), "silver": Chain("silver")}
-        self.tools = [Tool("weapon", (0,0), "W", self.chains["yellow"]),
-                      Tool("special", (0,1), "W", self.chains["yellow"]),
-                      Tool("intelligence", (1,2), "W", self.chains["yellow"]),
-                      Tool("intelligence", (2,0), "W"),
-                      Tool("radioactive", (2,1), "W"),
-                      Tool("radioactive", (2, 2), "W"),
-                      Tool("special", (0,3), "N", self.chains["orange"]),
-                      Tool("weapon", (1,3), "N", self.chains["orange"]),
-                      Tool("special", (1,5), "N", self.chains["orange"]),
-                      Tool("radioactive", (2,3), "N"),
-                      Tool("weapon", (2,4), "N"),
-                      Tool("radioactive", (2,5), "N"),
-                      Tool("intelligence", (0,6), "S", self.chains["silver"]),
-                      Tool("special", (1,6), "S", self.chains["silver"]),
-                      Tool("weapon", (1,8), "S", self.chains["silver"]),
-                      Tool("weapon", (2,6), "S"),
-                      Tool("radioactive", (2,7), "S"),
-                      Tool("special", (2,8), "S"),
-                      Tool("intelligence", (0, 9), "E", self.chains["orange"]),
-                      Tool("special", (1, 9), "E", self.chains["silver"]),
-                      Tool("weapon", (1, 11), "E", self.chains["yellow"]),
-                      Tool("radioactive", (2, 9), "E"),
-                      Tool("intelligence", (2, 10), "E"),
-                      Tool("radioactive", (2, 11), "E")]
-        self.surfacing = False
+        self.tools = [Tool(tool_type, cords, direction, self.chains[chain] if chain else None)
+                      for tool_type, cords, direction, chain in TOOLS_LAYOUT]
+        self.panel = ToolPanel(self.tools)
+        self.surfacing = None  # the timer ending the surfacing while surfacing
         self.surface_duration = SURFACE_DURATION
+        self.silence_length = MAX_SILENCE_LENGTH  # the most cells a silence moves the submarine
+        self.timers = None  # the game's timers, set by the game
+        self.on_change = None  # called with the affected views whenever the submarine changes, set by the game
+
+    @property
+    def path(self):
+        return self._path
+
+    @path.setter
+    def path(self, cords):
+        self._path = Path(self.masks, cords)
+
+    @property
+    def mines(self):
+        return self._mines
+
+    @mines.setter
+    def mines(self, cords):
+        self._mines = Mines(self.masks, cords)
+
+    def is_free(self, loc):
+        """
+        Returns True if the submarine can move to or plant a mine in the cell:
+        water it didn't visit since it last surfaced and without its mines
+        """
+        return self.map.in_map(loc) and not self.map.is_island(loc) and loc not in self.path and loc not in self.mines
+
+    def free_neighbors_mask(self):
+        """
+        Returns the free cells next to the submarine
+        """
+        return self.masks.neighbors(self.masks.bit(self.loc)) & self.masks.water & ~self.path.mask & ~self.mines.mask
+
+    def changed(self, *roles, enemy_roles=()):
+        """
+        Publishes a change affecting the given roles of this submarine's team and of the enemy team
+        """
+        if self.on_change:
+            enemy_team = game_file.Game.reverse_team(self.team)
+            self.on_change([(self.team, role) for role in roles] + [(enemy_team, role) for role in enemy_roles])
 
     def move(self, target):
         if not self.loc:
@@ -75,6 +135,7 @@ class Submarine:
             self.can_move = False
             self.first_mate_uncheck()
             self.engineer_uncheck()
+        self.changed(PlayerRole.CAPTAIN, PlayerRole.ENGINEER, enemy_roles=(PlayerRole.RADIO_OPERATOR,))
 
     def first_mate_uncheck(self):
         self.is_first_mate_check = False
@@ -85,41 +146,55 @@ class Submarine:
                 break
         else:
             self.is_first_mate_check = True
+        self.changed(PlayerRole.FIRST_MATE)
 
     def engineer_uncheck(self):
         self.is_engineer_check = False
+        self.changed(PlayerRole.ENGINEER)
 
     def engineer_check(self):
         self.is_engineer_check = True
         if self.is_first_mate_check:
             self.can_move = True
+        self.changed(PlayerRole.ENGINEER, PlayerRole.CAPTAIN)
 
     def first_mate_check(self):
         self.is_first_mate_check = True
         if self.is_engineer_check:
             self.can_move = True
+        self.changed(PlayerRole.FIRST_MATE, PlayerRole.CAPTAIN)
 
     def brake_tool(self, tool_to_brake):
         tool_to_brake.brake()
 
-        if tool_to_brake.type == "radioactive":
-            for tool in self.tools:
-                if tool.type == "radioactive" and not tool.is_broken:
-                    break
-            else: # if all "radioactive" tools are broken
-                self.hp -= 1
-                self.fix_all_tools()
+        if tool_to_brake.type == "radioactive" and self.panel.is_all_broken(tool_type="radioactive"):
+            self.hp = max(self.hp - 1, 0)
+            self.fix_all_tools()
 
-        for tool in self.tools:
-            if tool.direction == tool_to_brake.direction and not tool.is_broken:
-                break
-        else: # if all tools in the same direction are broken
-            self.hp -= 1
+        if self.panel.is_all_broken(direction=tool_to_brake.direction):
+            self.hp = max(self.hp - 1, 0)
             self.fix_all_tools()
+        self.changed(PlayerRole.ENGINEER, PlayerRole.FIRST_MATE)
 
     def fix_all_tools(self):
         for tool in self.tools:
             tool.fix()
+        self.changed(PlayerRole.ENGINEER)
+
+    def surface(self):
+        """
+        Starts surfacing, the path is erased and all tools are fixed
+        """
+        self.path = [self.path[-1]]
+        self.fix_all_tools()
+        self.surfacing = self.timers.call_later(self.surface_duration, self.stop_surfacing)
+        self.changed(*PlayerRole)
+
+    def stop_surfacing(self):
+        if self.surfacing:
+            self.surfacing.cancel()
+        self.surfacing = None
+        self.changed(*PlayerRole)
 
     def get_enemy_submarine(self, game):
         return [submarine for submarine in game.submarines if submarine is not self][0]
@@ -127,67 +202,62 @@ class Submarine:
     def can_plant_mine(self, game):
         if self.mine_action.charge != self.mine_action.max_charge:
             return False
-        for tool in self.tools:
-            if tool.type == "weapon" and tool.is_broken:
-                return False
-        for direction_cords in self.direction_dict.values():
-            new_loc = self.loc[0] + direction_cords[0], self.loc[1] + direction_cords[1]
-            if game_file.Game.in_map(new_loc) and not game.board[new_loc[0]][new_loc[1]].is_island and \
-                    new_loc not in self.path + self.mines:
-                break
-        else: # if there are no possible mine locations
+        if self.panel.is_any_broken("weapon"):
+            return False
+        if not self.free_neighbors_mask(): # if there are no possible mine locations
             return False
         return True
 
     def plant_mine(self, target):
-        self.mines.append(target)
+        self.mines.add(target)
         self.mine_action.charge = 0
+        self.changed(PlayerRole.CAPTAIN, PlayerRole.FIRST_MATE)
 
     def can_fire_torpedo(self):
         if self.torpedo_action.charge != self.torpedo_action.max_charge:
             return False
-        for tool in self.tools:
-            if tool.type == "weapon" and tool.is_broken:
-                return False
+        if self.panel.is_any_broken("weapon"):
+            return False
         return True
 
     def fire_torpedo(self, game, target):
         old_enemy_hp = self.get_enemy_submarine(game).hp
         self.bomb(game, target)
         self.torpedo_action.charge = 0
+        self.changed(PlayerRole.FIRST_MATE)
         return old_enemy_hp - self.get_enemy_submarine(game).hp
 
     def bomb(self, game, bomb_cords):
+        """
+        Explodes a bomb and every mine caught in the explosions it sets off, of both submarines,
+        returns the cords of the explosions in the order they happened
+        A submarine takes 2 damage from an explosion on it and 1 from an explosion next to it
+        """
         enemy_submarine = self.get_enemy_submarine(game)
-        if self.loc == bomb_cords:
-            self.hp = max(self.hp -2, 0)
-        elif math.hypot(self.loc[0] - bomb_cords[0], self.loc[1] - bomb_cords[1]) < EXPLOSION_SIZE:
-            self.hp = max(self.hp - 1, 0)
-        if enemy_submarine.loc == bomb_cords:
-            enemy_submarine.hp = max(enemy_submarine.hp -2, 0)
-        elif math.hypot(enemy_submarine.loc[0] - bomb_cords[0], enemy_submarine.loc[1] - bomb_cords[1]) < EXPLOSION_SIZE:
-            enemy_submarine.hp = max(enemy_submarine.hp - 1, 0)
-
-        mines_in_explosion_size = []
-        for mine in self.mines[:]:
-            if math.hypot(mine[0] - bomb_cords[0], mine[1] - bomb_cords[1]) < EXPLOSION_SIZE:
-                mines_in_explosion_size.append(mine)
-                self.mines.remove(mine)
-
-        for mine in enemy_submarine.mines[:]:
-            if math.hypot(mine[0] - bomb_cords[0], mine[1] - bomb_cords[1]) < EXPLOSION_SIZE:
-                mines_in_explosion_size.append(mine)
-                enemy_submarine.mines.remove(mine)
-
-        for mine in mines_in_explosion_size:
-            self.bomb(game, mine)
+        explosions = []
+        queue = deque([bomb_cords])
+        while queue:
+            explosion = queue.popleft()
+            explosions.append(explosion)
+            blast = self.masks.stencil(explosion, BLAST_OFFSETS)
+            for submarine in (self, enemy_submarine):
+                if submarine.loc == explosion:
+                    submarine.hp = max(submarine.hp - 2, 0)
+                elif self.masks.bit(submarine.loc) & blast:
+                    submarine.hp = max(submarine.hp - 1, 0)
+            # every mine explodes once, it is removed when the explosion reaching it is queued
+            for submarine in (self, enemy_submarine):
+                for mine in self.masks.cords(submarine.mines.mask & blast):
+                    submarine.mines.remove(mine)
+                    queue.append(mine)
+        self.changed(PlayerRole.CAPTAIN, PlayerRole.FIRST_MATE, enemy_roles=(PlayerRole.CAPTAIN, PlayerRole.FIRST_MATE))
+        return explosions
 
     def can_activate_mine(self):
         if self.mine_action.charge != self.mine_action.max_charge:
             return False
-        for tool in self.tools:
-            if tool.type == "weapon" and tool.is_broken:
-                return False
+        if self.panel.is_any_broken("weapon"):
+            return False
         if not self.mines:
             return False
 
@@ -199,26 +269,45 @@ class Submarine:
             self.mines.remove(target)
             self.bomb(game, target)
             self.mine_action.charge = 0
+            self.changed(PlayerRole.CAPTAIN, PlayerRole.FIRST_MATE)
         return old_enemy_hp - self.get_enemy_submarine(game).hp
 
-    def get_possible_silence_cords(self, game):
-        possible_silence_cords = []
-        for direction_cords in self.direction_dict.values():
-            for i in range(MAX_SILENCE_LENGTH):
-                curr_cord = direction_cords[0] * (i + 1) + self.loc[0], direction_cords[1] * (i + 1) + self.loc[1]
-                if not game.in_map(curr_cord) or game.board[curr_cord[0]][curr_cord[1]].is_island or curr_cord in self.path:
+    def silence_rays(self):
+        """
+        Returns the straight lines of water a silence can move the submarine along, ignoring its path
+        """
+        if self.loc is None:
+            return ()
+        return self.masks.rays(self.loc, self.silence_length)
+
+    def possible_silence_cells(self):
+        """
+        Yields the cells a silence can move the submarine to, as (cords, index of the cell's bit):
+        up to silence_length cells in a straight line through water it didn't visit
+        """
+        visited = self.path.visited
+        for ray in self.silence_rays():
+            for loc, index in ray:
+                if loc in visited:
                     break
-                possible_silence_cords.append(curr_cord)
+                yield loc, index
 
-        return possible_silence_cords
+    def get_possible_silence_mask(self):
+        possible_silence_mask = 0
+        for loc, index in self.possible_silence_cells():
+            possible_silence_mask |= 1 << index
+        return possible_silence_mask
+
+    def get_possible_silence_cords(self, game):
+        return sorted(loc for loc, index in self.possible_silence_cells())
 
     def can_silence(self, game):
         if self.silence_action.charge != self.silence_action.max_charge:
             return False
-        for tool in self.tools:
-            if tool.type == "special" and tool.is_broken:
-                return False
-        if not self.get_possible_silence_cords(game):
+        if self.panel.is_any_broken("special"):
+            return False
+        # the submarine can silence if the first cell of any ray is free
+        if not any(ray and ray[0][0] not in self.path for ray in self.silence_rays()):
             return False
         return True
 
@@ -232,22 +321,25 @@ class Submarine:
             self.path.append(self.loc)
 
         self.last_move_direction = str(int(self.last_move_direction.split(' ')[0]) + 1) + " - Silence"
+        self.changed(PlayerRole.CAPTAIN, PlayerRole.FIRST_MATE, PlayerRole.ENGINEER,
+                     enemy_roles=(PlayerRole.RADIO_OPERATOR,))
 
     def can_drone(self):
         if self.drone_action.charge != self.drone_action.max_charge:
             return False
-        for tool in self.tools:
-            if tool.type == "intelligence" and tool.is_broken:
-                return False
+        if self.panel.is_any_broken("intelligence"):
+            return False
         return True
 
     def activate_drone(self, game, target_section):
         self.drone_action.charge = 0
+        self.changed(PlayerRole.FIRST_MATE)
         enemy_loc = self.get_enemy_submarine(game).loc
-        return target_section == game.board[enemy_loc[0]][enemy_loc[1]].section
+        return target_section == self.map.section_of(enemy_loc)
 
     def format_sonar_answer(self, game, answer_data):
         self.sonar_action.charge = 0
+        self.changed(PlayerRole.FIRST_MATE)
         true_statement_type, false_statement_type, false_statement_data = answer_data
 
         if true_statement_type == "row":
@@ -258,7 +350,7 @@ class Submarine:
             true_answer = f"{true_statement_type}: {col}"
         else:
             enemy_loc = self.get_enemy_submarine(game).loc
-            section = game.board[enemy_loc[0]][enemy_loc[1]].section
+            section = self.map.section_of(enemy_loc)
             true_answer = f"{true_statement_type}: {section}"
         false_answer = f"{false_statement_type}: {false_statement_data}"
 
@@ -270,12 +362,75 @@ class Submarine:
     def can_sonar(self):
         if self.sonar_action.charge != self.sonar_action.max_charge:
             return False
-        for tool in self.tools:
-            if tool.type == "intelligence" and tool.is_broken:
-                return False
+        if self.panel.is_any_broken("intelligence"):
+            return False
         return True
 
+class Path:
+    """
+    The cells the submarine visited since it last surfaced, in order, with a set and a mask of them
+    so checking whether it visited a cell takes constant time however long the path is
+    """
+    __slots__ = ("masks", "cords", "visited", "mask")
+
+    def __init__(self, masks, cords=()):
+        self.masks = masks
+        self.cords = []
+        self.visited = set()
+        self.mask = 0
+        for loc in cords:
+            self.append(loc)
+
+    def append(self, loc):
+        self.cords.append(loc)
+        self.visited.add(loc)
+        self.mask |= self.masks.bit(loc)
+
+    def __contains__(self, loc):
+        return loc in self.visited
+
+    def __iter__(self):
+        return iter(self.cords)
+
+    def __len__(self):
+        return len(self.cords)
+
+    def __getitem__(self, index):
+        return self.cords[index]
+
+
+class Mines:
+    """
+    A submarine's mines, in the order they were planted, as an ordered set with a mask of them
+    """
+    __slots__ = ("masks", "cords", "mask")
+
+    def __init__(self, masks, cords=()):
+        self.masks = masks
+        self.cords = dict.fromkeys(cords)
+        self.mask = masks.mask(self.cords)
+
+    def add(self, loc):
+        self.cords[loc] = None
+        self.mask |= self.masks.bit(loc)
+
+    def remove(self, loc):
+        del self.cords[loc]
+        self.mask &= ~self.masks.bit(loc)
+
+    def __contains__(self, loc):
+        return loc in self.cords
+
+    def __iter__(self):
+        return iter(self.cords)
+
+    def __len__(self):
+        return len(self.cords)
+
+
 class PowerAction:
+    __slots__ = ("type", "charge", "max_charge", "name")
+
     def __init__(self, name, type, max_charge):
         self.type = type
         self.charge = 0
@@ -289,6 +444,8 @@ class PowerAction:
         return self.charge < self.max_charge
 
 class Tool:
+    __slots__ = ("type", "cords", "is_broken", "chain", "direction", "panel")
+
     def __init__(self, type, cords, direction, chain=None):
         self.type = type
         self.cords = cords
@@ -297,24 +454,81 @@ class Tool:
         if chain:
             chain.tools.append(self)
         self.direction = direction
+        self.panel = None  # the panel counting the broken tools, set by the panel
 
     def fix(self):
-        self.is_broken = False
+        if self.is_broken:
+            self.is_broken = False
+            if self.panel:
+                self.panel.one_fixed(self)
+            if self.chain:
+                self.chain.broken_count -= 1
 
     def brake(self):
+        if self.is_broken:
+            return
         self.is_broken = True
+        if self.panel:
+            self.panel.one_broken(self)
         if self.chain:
-            self.chain.one_fixed()
+            self.chain.one_broken()
 
 class Chain:
+    __slots__ = ("tools", "color", "broken_count")
+
     def __init__(self, color):
         self.tools = []
         self.color = color
-
-    def one_fixed(self):
-        for tool in self.tools:
-            if not tool.is_broken:
-                break
-        else:
+        self.broken_count = 0
+
+    def one_broken(self):
+        """
+        Fixes the chain's tools once they are all broken
+        """
+        self.broken_count += 1
+        if self.broken_count == len(self.tools):
             for tool in self.tools:
                 tool.fix()
+
+class ToolPanel:
+    """
+    The engineer's tools, laid out as in TOOLS_LAYOUT, with the number of broken tools per type and per direction
+    kept up to date by the tools as they brake and get fixed, so checking them doesn't scan the tools
+    """
+    __slots__ = ("tools", "broken_counts")
+
+    def __init__(self, tools):
+        self.tools = tools
+        self.broken_counts = dict.fromkeys(TOOL_COUNTS, 0)  # type or direction: the number of broken tools
+        for tool in tools:
+            tool.panel = self
+            if tool.is_broken:
+                self.one_broken(tool)
+
+    def tool_at(self, cords):
+        """
+        Returns the tool at the cords, None if there is none
+        """
+        try:
+            index = TOOL_INDICES.get(cords)
+        except TypeError:  # unhashable cords sent by a client
+            return None
+        return None if index is None else self.tools[index]
+
+    def one_broken(self, tool):
+        self.broken_counts[tool.type] += 1
+        self.broken_counts[tool.direction] += 1
+
+    def one_fixed(self, tool):
+        self.broken_counts[tool.type] -= 1
+        self.broken_counts[tool.direction] -= 1
+
+    def is_any_broken(self, tool_type):
+        return self.broken_counts[tool_type] > 0
+
+    def is_all_broken(self, tool_type=None, direction=None):
+        """
+        Returns True if all the tools of the type, or in the direction, are broken
+        """
+        key = tool_type if direction is None else direction
+        return self.broken_counts[key] == TOOL_COUNTS[key]
@@ -0,0 +1,201 @@
+"""
+Server side timers: surfacing countdowns, power timeouts, idle client kicks
+
+One scheduler thread owns a heap of deadlines on the monotonic clock and fires every timer once,
+so the cost of the timers doesn't depend on the number of connections.
+The timers of a game are grouped so they can be paused while the game is stopped,
+and they run on the game's actor like any other change to the game.
+"""
+import time
+import heapq
+import logging
+import itertools
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class Timer:
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def time_left(self):
+        return self.deadline - time.monotonic()
+
+
+class Scheduler:
+    """
+    Fires timers from a single thread, started on the first timer
+    Callbacks run on the scheduler's thread so they should only hand the work off
+    """
+    def __init__(self):
+        self.heap = []  # (deadline, sequence number, timer), cancelled timers are dropped when they reach the top
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def call_later(self, delay, callback, *args):
+        """
+        Calls callback(*args) after delay seconds and returns the timer
+        """
+        timer = Timer(time.monotonic() + delay, callback, args)
+        with self.condition:
+            heapq.heappush(self.heap, (timer.deadline, next(self.counter), timer))
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run, name="timers", daemon=True)
+                self.thread.start()
+            if self.heap[0][2] is timer:  # the scheduler has to wake up earlier
+                self.condition.notify()
+        return timer
+
+    def next_due_timer(self):
+        """
+        Waits for the next timer to be due and returns it
+        """
+        with self.condition:
+            while True:
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                deadline, _, timer = self.heap[0]
+                if timer.cancelled:
+                    heapq.heappop(self.heap)
+                    continue
+                time_left = deadline - time.monotonic()
+                if time_left <= 0:
+                    heapq.heappop(self.heap)
+                    return timer
+                self.condition.wait(time_left)
+
+    def run(self):
+        while True:
+            timer = self.next_due_timer()
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                log.exception("timer %s failed", timer.callback)
+
+
+scheduler = Scheduler()
+
+
+class GroupTimer:
+    """
+    A timer of a TimerGroup, it remembers the time it had left while the group is paused
+    """
+    def __init__(self, group, delay, callback, args):
+        self.group = group
+        self.remaining = delay
+        self.callback = callback
+        self.args = args
+        self.timer = None
+        self.generation = 0  # bumped whenever the scheduled timer is dropped, so a stale fire is ignored
+
+    def start(self):
+        self.generation += 1
+        self.timer = self.group.scheduler.call_later(self.remaining, self.due, self.generation)
+
+    def stop(self):
+        if self.timer:
+            self.remaining = max(self.timer.time_left(), 0)
+            self.timer.cancel()
+            self.timer = None
+            self.generation += 1
+
+    def due(self, generation):
+        """
+        Runs on the scheduler's thread
+        """
+        if self.group.run:
+            self.group.run(self.fire, generation)
+        else:
+            self.fire(generation)
+
+    def fire(self, generation):
+        if generation != self.generation or not self.timer:
+            return
+        self.timer = None
+        self.group.timers.discard(self)
+        self.callback(*self.args)
+
+    def cancel(self):
+        self.stop()
+        self.group.timers.discard(self)
+
+    def time_left(self):
+        return self.timer.time_left() if self.timer else self.remaining
+
+
+class TimerGroup:
+    """
+    The timers of one game, paused while the game is stopped
+    Due timers are run by run(func, *args), the game's actor sets it to its submit so the timers
+    change the game in order with the commands. Without it they run on the scheduler's thread.
+    """
+    def __init__(self, timers_scheduler=None):
+        self.scheduler = timers_scheduler or scheduler
+        self.run = None
+        self.timers = set()
+        self.is_paused = False
+
+    def call_later(self, delay, callback, *args):
+        """
+        Calls callback(*args) once the group ran for delay more seconds and returns the timer
+        """
+        timer = GroupTimer(self, delay, callback, args)
+        self.timers.add(timer)
+        if not self.is_paused:
+            timer.start()
+        return timer
+
+    def pause(self):
+        if not self.is_paused:
+            self.is_paused = True
+            for timer in self.timers:
+                timer.stop()
+
+    def resume(self):
+        if self.is_paused:
+            self.is_paused = False
+            for timer in self.timers:
+                timer.start()
+
+    def cancel_all(self):
+        for timer in tuple(self.timers):
+            timer.cancel()
+
+
+class IdleTimer:
+    """
+    Calls kick once touch() was not called for timeout seconds
+    Touching only records the time, the timer is rescheduled when it fires early
+    """
+    def __init__(self, timeout, kick, timers_scheduler=None):
+        self.timeout = timeout
+        self.kick = kick
+        self.scheduler = timers_scheduler or scheduler
+        self.last_active = time.monotonic()
+        self.is_cancelled = False
+        self.timer = self.scheduler.call_later(timeout, self.check)
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def check(self):
+        if self.is_cancelled:
+            return
+        idle_time = time.monotonic() - self.last_active
+        if idle_time >= self.timeout:
+            self.kick()
+        else:
+            self.timer = self.scheduler.call_later(self.timeout - idle_time, self.check)
+
+    def cancel(self):
+        self.is_cancelled = True
+        self.timer.cancel()